@@ -42,141 +42,346 @@
 #
 #   Set "arguments" to the path of the script, specifying the use of a temporary 
 #   file
-#     (e.g. "C:\Users\<username>\.jason\externalNMRProcessing\python\scale_1d.py -f $TMPFILE -m <MODE> [--scale <VALUE>])
+#     (e.g. "C:\Users\<username>\.jason\externalNMRProcessing\python\T2_fid_analysis.py -f $TMPFILE [--errors mc --mc <N>])
+#     the file can also be given without -f (T2_fid_analysis.py $TMPFILE), as in earlier versions of the script
+#     the --errors option selects how the fitting errors are determined: analytic (default) uses the
+#       covariance matrix of the fit, mc uses Monte-Carlo resampling (slower, useful for validation)
+#     the --mc option sets the number of Monte-Carlo datasets used for the error estimate, default = 1000
+#     the --seed option seeds the random number generator used for the Monte-Carlo datasets
+#     the --mc-validate option also fits the Monte-Carlo datasets one at a time with leastsq
+#       and reports how the two sets of results compare
+#     the -w (--workers) option sets the number of processes used to analyse the multiplets, default = 1
+#     the --fft-workers option sets the number of threads used to transform the multiplets, default = all
+#     the -p (--plot) option selects how the fits are plotted: show (default) opens a window per
+#       multiplet, png writes them to files in the background without blocking, none skips plotting
+#     the --outdir option sets the folder for the png files, default = folder of the data file
+#     the --csv option also writes the table of results to the given file
+#
+#  The relaxation models are read from relaxation.py, which must be in the same folder as this script
+#
+#  The table of T2, R2 and linewidth results with errors is written into the document under
+#  JasonDocument/T2Analysis, so batch runs (e.g. with "-p png" or "-p none") need no interaction
 #
 # Press "Apply"
 
-import sys
+import os
 import h5py
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from time import perf_counter
 
 import numpy as np
-import matplotlib.pyplot as plt
 
-from numpy.random import randn
 from scipy.optimize import leastsq
-from scipy.fft import fft, ifft, fftshift
+from scipy.fft import ifft
 
-from daylab.relaxation import spinecho, residuals_spinecho
+from relaxation import fit_monoexp, loglinear_estimate, monoexp, monoexp_jacobian, residuals
 
 
-# Open a file handle for the Jason datafile
+def extract_fids(spectrum, limits, workers=-1):
+    """FID envelopes of all multiplets from a single batched iFFT.
 
-f = h5py.File(sys.argv[1], "r+")
-print('Opening dataset: ', sys.argv[1])
+    Each multiplet spectrum is the region limits[i] of spectrum, rolled to
+    put its maximum at zero frequency, fftshifted and flipped. Those moves
+    are all index permutations, so every region is written straight to its
+    final position in one (nmultiplets x npts) array, which is then
+    transformed along its rows in one call.
+    """
 
+    npts = len(spectrum)
+    specs = np.zeros((len(limits), npts))
 
-# Read the spectrum
+    for i, (lo, hi) in enumerate(limits):
+        window = spectrum[lo:hi]
 
-dataset_real = f['JasonDocument/DataPoints/0'][()]
-dataset_imag = f['JasonDocument/DataPoints/1'][()]
+        peak_max_idx = lo + window.argmax()
+        shift = npts//2 - peak_max_idx - 1 + npts//2
 
+        specs[i, npts - 1 - (np.arange(lo, hi) + shift) % npts] = window
 
-# Get some parameters from the data
+    fids = ifft(specs, axis=1, workers=workers)
 
-npts = f['JasonDocument'].attrs['Length'][0]
-sw = f['JasonDocument']['SpecInfo'].attrs['SW'][0]
-sfrq = f['JasonDocument/SpecInfo'].attrs['SpectrometerFrequencies'][0]
-sref = f['JasonDocument/SpecInfo'].attrs['SpectrumRef'][0]
+    return fids[:, :npts//2].real
 
-dw = 1.0 / sw
-sw = sw / sfrq
-x_offset = sref / sfrq
-sp = x_offset - sw / 2.0
 
+def jacobian(p, model, t, y):
+    """Jacobian of the mono-exponential residuals, in the form expected by leastsq"""
 
-multiplets = f['JasonDocument']['Multiplets_Integrals']['MultipletList'].values()
+    return -monoexp_jacobian(p, t)
 
-nmultiplets = len(multiplets)
 
-xRange = []
+def analyse_multiplet(task):
+    """Fit and estimate the errors for a single multiplet.
 
-for peak in multiplets:
-    # Extract peak of interest
+    Only the FID envelope of the multiplet is passed in, so that the task
+    is cheap to send to a worker process. Returns the time axis, the FID
+    envelope, the fitted parameters and their errors.
+    """
 
-    integral = peak.attrs['SpectrumRange[0]']
+    fid, dw, intpos, options = task
 
-    intpos = integral.mean()
-    intlimit = np.array(npts * (integral - sp) / sw, dtype=int)
-    
-    if intlimit[0] < 1:
-        intlimit[0] = 1
 
-    if intlimit[1] > npts:
-        intlimit[1] = npts
+    # Fit the FID
 
-    intlimit = npts - intlimit
+    time_pts = np.linspace(0, len(fid)*dw, len(fid))
 
-    spec = dataset_real.copy()
+    p0 = loglinear_estimate(time_pts, fid)
 
-    spec[:intlimit[1]] = 0.0
-    spec[intlimit[0]:] = 0.0
+    p1, cov_x, infodict, mesg, success = leastsq(residuals, p0.copy(), \
+        args=(monoexp, time_pts, fid), Dfun=jacobian, full_output=True)
 
 
-    # Shift to zero frequency and iFFT
+    # Determine the fitting error from the covariance matrix at the solution,
+    # scaled by the variance of the residuals
 
-    peak_max_idx = spec.argmax()
-    spec = np.roll(spec, npts//2 - peak_max_idx - 1)
+    errors = np.zeros(2)
 
-    fid = ifft(np.flipud(fftshift(spec, 0)), npts)
-    fid = fid[:npts//2]
-    fid = fid.real
+    if options['errors'] == 'analytic' and cov_x is not None:
+        resid_var = (infodict['fvec']**2).sum() / (len(time_pts) - len(p1))
+        errors = np.sqrt(np.diag(cov_x) * resid_var)
 
 
-    # Fit the FID
+    # Alternatively, determine the fitting error by Monte-Carlo, generating all
+    # of the mock datasets at once and fitting them together
+
+    num_mc = options['mc']
 
-    fix0 = []
-    p1 = np.zeros(3)
-    time_pts = np.linspace(0, npts//2*dw, npts//2)
+    if options['errors'] == 'mc' and num_mc > 0:
+        rng = np.random.default_rng(options['seed'])
 
-    p0 = [fid.max(), 1.0]
+        sigma = np.std(residuals(p1, monoexp, time_pts, fid))
 
-    p1, success = leastsq(residuals_spinecho, p0.copy(), \
-        args=(fix0, time_pts, fid))
+        mock_data = monoexp(p1, time_pts) + sigma \
+            * rng.standard_normal((num_mc, len(time_pts)))
 
+        start = perf_counter()
+        mocked_parameters = fit_monoexp(time_pts, mock_data, p1)
+        batch_time = perf_counter() - start
 
-    # Determine the fitting error by Monte-Carlo
+        errors = np.std(mocked_parameters, axis=0)
 
-    mc_errors = np.zeros(2)
-    num_mc = 1000
 
-    if num_mc > 0:
-        sigma = np.std(residuals_spinecho(p1, fix0, time_pts, fid))
+        # If requested, repeat the fits one at a time to validate the batched fit
 
-        mocked_parameters = np.zeros((num_mc, 2), dtype=float)
+        if options['mc_validate']:
+            serial_parameters = np.zeros((num_mc, 2), dtype=float)
 
-        for i in range(num_mc):
-            mock_data =spinecho(p1, fix0, time_pts) + sigma \
-                * randn(len(time_pts))
-            p2, success = leastsq(residuals_spinecho, p1.copy(), \
-                args=(fix0, time_pts, mock_data))
-            mocked_parameters[i, :] = p2
+            start = perf_counter()
 
-        mc_errors = np.std(mocked_parameters, axis=0)
+            for i in range(num_mc):
+                p2, success = leastsq(residuals, p1.copy(), \
+                    args=(monoexp, time_pts, mock_data[i]), Dfun=jacobian)
+                serial_parameters[i, :] = p2
 
+            serial_time = perf_counter() - start
+            serial_errors = np.std(serial_parameters, axis=0)
 
-    # Plot the results
+            print('Monte-Carlo at {label:.2f} ppm: batched {batch:.3f} s, serial {serial:.3f} s'\
+                .format(label=intpos, batch=batch_time, serial=serial_time))
+            print('    T2 error batched {batch:.4g} s, serial {serial:.4g} s, max |dT2| {diff:.3g} s'\
+                .format(batch=errors[1], serial=serial_errors[1], \
+                diff=np.abs(mocked_parameters[:, 1] - serial_parameters[:, 1]).max()))
 
-    plt.plot(time_pts, fid)
-    plt.plot(time_pts, spinecho(p1, fix0, time_pts))
+    return time_pts, fid, p1, errors
 
-    plt.title('FID envelope fit at {label:.2f} ppm'.format(label=intpos))
-    plt.xlabel('Time / s')
-    plt.ylabel('FID Intensity / a.u.')
 
-    plt.annotate('$T_2$ = {label:.2f} +/- {labelerr:.3f} s'\
-        .format(label=p1[1],  labelerr=mc_errors[1]), (0.65, 0.75), \
+def draw_fit(ax, time_pts, fid, p1, errors, intpos):
+    """Draw the FID envelope, its fit and the fitted values onto ax"""
+
+    ax.plot(time_pts, fid)
+    ax.plot(time_pts, monoexp(p1, time_pts))
+
+    ax.set_title('FID envelope fit at {label:.2f} ppm'.format(label=intpos))
+    ax.set_xlabel('Time / s')
+    ax.set_ylabel('FID Intensity / a.u.')
+
+    ax.annotate('$T_2$ = {label:.2f} +/- {labelerr:.3f} s'\
+        .format(label=p1[1],  labelerr=errors[1]), (0.65, 0.75), \
         xycoords='axes fraction')
-    plt.annotate('$R_2$ = {label:.2f} +/- {labelerr:.3f} Hz'\
-        .format(label=1.0 / p1[1],  labelerr=mc_errors[1] / p1[1]**2), (0.65, 0.70), \
+    ax.annotate('$R_2$ = {label:.2f} +/- {labelerr:.3f} Hz'\
+        .format(label=1.0 / p1[1],  labelerr=errors[1] / p1[1]**2), (0.65, 0.70), \
         xycoords='axes fraction')
-    plt.annotate('$LW$ = {label:.2f} +/- {labelerr:.3f} Hz'\
-        .format(label=1.0 / (np.pi * p1[1]),  labelerr=mc_errors[1] / (np.pi * p1[1]**2)), (0.65, 0.65), \
+    ax.annotate('$LW$ = {label:.2f} +/- {labelerr:.3f} Hz'\
+        .format(label=1.0 / (np.pi * p1[1]),  labelerr=errors[1] / (np.pi * p1[1]**2)), (0.65, 0.65), \
         xycoords='axes fraction')
 
-    plt.show()
 
+def save_fit(filename, *fit):
+    """Render a fit to a png file without pyplot, so it is safe off the main thread"""
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    draw_fit(fig.add_subplot(), *fit)
+    fig.savefig(filename)
+
+
+if __name__ == '__main__':
+    # Parse the commandline arguments
+
+    parser = ArgumentParser()
+    # the file name is also accepted as a positional argument, so existing JASON setups keep working
+    parser.add_argument("file", action="store", nargs="?")
+    parser.add_argument("-f", "--filename", action="store")
+    parser.add_argument("--errors", action="store", default="analytic", choices=["analytic", "mc"])
+    parser.add_argument("--mc", action="store", type=int, default=1000)
+    parser.add_argument("--seed", action="store", type=int, default=None)
+    parser.add_argument("--mc-validate", action="store_true")
+    parser.add_argument("-w", "--workers", action="store", type=int, default=1)
+    parser.add_argument("--fft-workers", action="store", type=int, default=-1)
+    parser.add_argument("-p", "--plot", action="store", default="show", choices=["show", "png", "none"])
+    parser.add_argument("--outdir", action="store", default=None)
+    parser.add_argument("--csv", action="store", default=None)
+
+    args = parser.parse_args()
+
+    args.filename = args.filename or args.file
+
+    if args.filename is None:
+        parser.error("the data file must be given, either with -f or as a positional argument")
+
+    outdir = args.outdir or os.path.dirname(os.path.abspath(args.filename))
+
+    if args.plot == 'png' and not os.path.isdir(outdir):
+        parser.error("output folder {outdir} does not exist".format(outdir=outdir))
+
+
+    # Open a file handle for the Jason datafile
+
+    f = h5py.File(args.filename, "r+")
+    print('Opening dataset: ', args.filename)
+
+
+    # Read the spectrum
+
+    dataset_real = f['JasonDocument/DataPoints/0'][()]
+    dataset_imag = f['JasonDocument/DataPoints/1'][()]
+
+
+    # Get some parameters from the data
+
+    npts = f['JasonDocument'].attrs['Length'][0]
+    sw = f['JasonDocument']['SpecInfo'].attrs['SW'][0]
+    sfrq = f['JasonDocument/SpecInfo'].attrs['SpectrometerFrequencies'][0]
+    sref = f['JasonDocument/SpecInfo'].attrs['SpectrumRef'][0]
+
+    dw = 1.0 / sw
+    sw = sw / sfrq
+    x_offset = sref / sfrq
+    sp = x_offset - sw / 2.0
+
+
+    multiplets = f['JasonDocument']['Multiplets_Integrals']['MultipletList'].values()
+
+    nmultiplets = len(multiplets)
+
+
+    # Each multiplet gets its own stream of random numbers, so that the
+    # Monte-Carlo results do not depend on the number of workers
+
+    seeds = np.random.SeedSequence(args.seed).spawn(nmultiplets)
+
+    limits = []
+    positions = []
+
+    for peak in multiplets:
+        # Extract peak of interest
+
+        integral = peak.attrs['SpectrumRange[0]']
+
+        intpos = integral.mean()
+        intlimit = np.array(npts * (integral - sp) / sw, dtype=int)
+
+        if intlimit[0] < 1:
+            intlimit[0] = 1
+
+        if intlimit[1] > npts:
+            intlimit[1] = npts
+
+        intlimit = npts - intlimit
+
+        limits.append((intlimit[1], intlimit[0]))
+        positions.append(intpos)
+
+
+    # Shift each peak to zero frequency and iFFT, all multiplets at once
+
+    fids = extract_fids(dataset_real, limits, args.fft_workers)
+
+    tasks = [(fid, dw, intpos, dict(errors=args.errors, mc=args.mc, seed=seed, mc_validate=args.mc_validate))
+        for fid, intpos, seed in zip(fids, positions, seeds)]
+
+
+    # Analyse the multiplets, in a pool of worker processes if requested.
+    # The results come back in the same order as the multiplets
+
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            results = pool.map(analyse_multiplet, tasks)
+    else:
+        results = [analyse_multiplet(task) for task in tasks]
+
+
+    # Plot the results, either interactively or as png files rendered by a
+    # background thread while the remaining results are handled
+
+    if args.plot == 'show':
+        import matplotlib.pyplot as plt
+
+        for intpos, (time_pts, fid, p1, errors) in zip(positions, results):
+            fig, ax = plt.subplots()
+            draw_fit(ax, time_pts, fid, p1, errors, intpos)
+            plt.show()
+
+    elif args.plot == 'png':
+        renderer = ThreadPoolExecutor(max_workers=1)
+        rendered = []
+
+        for intpos, (time_pts, fid, p1, errors) in zip(positions, results):
+            filename = os.path.join(outdir, 'T2_fit_{label:.2f}ppm.png'.format(label=intpos))
+            rendered.append(renderer.submit(save_fit, filename, time_pts, fid, p1, errors, intpos))
+
+
+    # Tabulate T2, R2 and the linewidth with their errors
+
+    T2 = np.array([p1[1] for _, _, p1, _ in results])
+    T2_err = np.array([errors[1] for _, _, _, errors in results])
+
+    table = {
+        'Position': np.array(positions),
+        'T2': T2,
+        'T2Error': T2_err,
+        'R2': 1.0 / T2,
+        'R2Error': T2_err / T2**2,
+        'LW': 1.0 / (np.pi * T2),
+        'LWError': T2_err / (np.pi * T2**2),
+    }
+
+    if 'JasonDocument/T2Analysis' in f:
+        del f['JasonDocument/T2Analysis']
+
+    group = f.create_group('JasonDocument/T2Analysis')
+
+    for name, values in table.items():
+        group.create_dataset(name, data=values)
+
+    if args.csv is not None:
+        np.savetxt(args.csv, np.column_stack(list(table.values())), delimiter=',', \
+            header=','.join(table), comments='')
+
+    print('Results written for {n} multiplets'.format(n=nmultiplets))
+
+    if args.plot == 'png':
+        # Raise any error from saving the plots
+        for future in rendered:
+            future.result()
+
+        renderer.shutdown()
 
 
-# Write back the processed dataset
+    # Write back the processed dataset
 
-f.close()
+    f.close()
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+
+# -------------------------------------------------------------------------------
+# --
+# -- JEOL Ltd.
+# -- 1-2 Musashino 3-Chome
+# -- Akishima Tokyo 196-8558 Japan
+# --
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# --++---------------------------------------------------------------------------
+# --
+# -- ModuleName : deconvolution_fft.py
+# -- ModuleType : Benchmark for the example external command scripts for JASON
+# -- Purpose : Time the Fourier transforms used by the reference deconvolution scripts
+# -- Language : Python
+# --
+# --##---------------------------------------------------------------------------
+#
+# Times the inverse transform of a block of real spectra to the first half of
+# their FIDs, as done by reference_deconvolution_1D.py and
+# reference_deconvolution_pseudo2D.py, with the flip, fftshift and complex
+# ifft used previously and with the rotation and real-input rfft used now, on
+# awkward lengths of the form 2.3.5.7.k. The complex transform padded to
+# next_fast_len is also timed for comparison.
+#
+# Usage: python deconvolution_fft.py [-r rows] [-n repeats] [--fft-workers n]
+
+from argparse import ArgumentParser
+from timeit import repeat
+import numpy as np
+from scipy.fft import ifft, rfft, fftshift, next_fast_len
+
+parser = ArgumentParser()
+# number of spectra transformed together
+parser.add_argument("-r", "--rows", action="store", type=int, default=64)
+# number of timing repeats, the best is reported
+parser.add_argument("-n", "--repeats", action="store", type=int, default=5)
+# number of threads used for the Fourier transforms
+parser.add_argument("--fft-workers", action="store", type=int, default=-1)
+
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+
+print('  npts   fast len    ifft (ms)   rfft (ms)  speedup   ifft at fast len (ms)   max diff')
+
+for k in (3, 10, 13, 19, 29, 39):
+    npts = 2 * 3 * 5 * 7 * k
+    fast = next_fast_len(npts)
+    spectra = rng.standard_normal((args.rows, npts))
+
+    def complex_path():
+        return ifft(np.flip(fftshift(spectra, axes=1), axis=1), npts, axis=1, workers=args.fft_workers)[:, :npts//2]
+
+    def real_path():
+        return rfft(np.roll(spectra, npts//2 + 1, axis=1), npts, axis=1, norm='forward', workers=args.fft_workers)[:, :npts//2]
+
+    def fast_path():
+        return ifft(np.flip(fftshift(spectra, axes=1), axis=1), fast, axis=1, workers=args.fft_workers)[:, :npts//2]
+
+    times = [1000 * min(repeat(fn, number=10, repeat=args.repeats)) / 10 for fn in (complex_path, real_path, fast_path)]
+    diff = np.abs(complex_path() - real_path()).max()
+
+    print('{0:6d} {1:10d} {2:12.3f} {3:11.3f} {4:8.2f} {5:23.3f} {6:10.1e}'.format(npts, fast, times[0], times[1], times[0] / times[1], times[2], diff))
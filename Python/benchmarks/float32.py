@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+
+# -------------------------------------------------------------------------------
+# --
+# -- JEOL Ltd.
+# -- 1-2 Musashino 3-Chome
+# -- Akishima Tokyo 196-8558 Japan
+# --
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# --++---------------------------------------------------------------------------
+# --
+# -- ModuleName : float32.py
+# -- ModuleType : Benchmark for the example external command scripts for JASON
+# -- Purpose : Compare the float64 and float32 modes of the processing scripts
+# -- Language : Python
+# --
+# --##---------------------------------------------------------------------------
+#
+# Runs each processing script that has a --dtype option on a synthetic JJH5
+# document, once with --dtype float64 and once with --dtype float32, and
+# reports the run times, the speedup and the maximum deviation of the float32
+# result from the float64 one, relative to the largest value of the float64
+# result. The run times are for the whole script, including starting Python
+# and reading and writing the file.
+#
+# Usage: python float32.py [-s scale] [-n repeats]
+
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from shutil import copyfile
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import h5py
+import numpy as np
+
+parser = ArgumentParser()
+# multiplies the size of every synthetic spectrum
+parser.add_argument("-s", "--scale", action="store", type=int, default=1)
+# number of runs of each script, the best is reported
+parser.add_argument("-n", "--repeats", action="store", type=int, default=3)
+
+args = parser.parse_args()
+
+scripts = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+rng = np.random.default_rng(0)
+
+
+def lorentzians(npts, peaks, sw=5000.0, sfrq=500.0, sref=2000.0):
+    """Sum of Lorentzian lines (position in ppm, height, width in Hz)"""
+
+    ppm = sref / sfrq + sw / sfrq * (0.5 - np.arange(npts) / npts)
+
+    return sum(height * width**2 / (width**2 + ((ppm - centre) * sfrq)**2) for centre, height, width in peaks)
+
+
+def document(path, real):
+    """Write a minimal JJH5 document holding the 1D or 2D spectrum"""
+
+    with h5py.File(path, 'w') as f:
+        doc = f.create_group('JasonDocument')
+        doc.attrs['Length'] = np.array(real.shape[::-1], dtype=np.int32)
+
+        info = doc.create_group('SpecInfo')
+        info.attrs['SW'] = np.array([5000.0, 4000.0])
+        info.attrs['SpectrometerFrequencies'] = np.array([500.0, 500.0])
+        info.attrs['SpectrumRef'] = np.array([2000.0, 1000.0])
+
+        doc.create_dataset('DataPoints/0', data=real)
+        doc.create_dataset('DataPoints/1', data=0.01 * rng.standard_normal(real.shape))
+
+
+# The synthetic spectra, each a few peaks on a noisy baseline
+
+npts1d = 262144 * args.scale
+spec1d = lorentzians(npts1d, [(0.0, 1.0, 1.5), (2.0, 0.7, 1.5), (5.3, 0.4, 2.0)]) \
+    + 0.001 * rng.standard_normal(npts1d)
+
+rows, cols = 1024 * args.scale, 2048
+spec2d = 0.1 * rng.standard_normal((rows, cols))
+spec2d[:, 400] += 0.5 * rng.standard_normal(rows)
+spec2d[100:104, 400] += 20.0
+spec2d[200:203, 1200] += 15.0
+
+pseudo2d = lorentzians(8192, [(0.0, 1.0, 1.5), (2.0, 0.7, 1.5)]) * np.exp(-np.arange(rows // 4) / 50.0)[:, None] \
+    + 0.001 * rng.standard_normal((rows // 4, 8192))
+
+benchmarks = [
+    ('scale_1d.py', spec1d, ['-m', 'max']),
+    ('reference_deconvolution_1D.py', spec1d, ['-l', '1.0']),
+    ('reference_deconvolution_pseudo2D.py', pseudo2d, ['-l', '1.0']),
+    ('noise_reduction.py', spec2d, []),
+    ('direct_covariance.py', spec2d, []),
+    ('indirect_covariance.py', spec2d, []),
+]
+
+
+print('{0:38s} {1:>12s} {2:>12s} {3:>8s} {4:>14s}'.format('script', 'float64 (s)', 'float32 (s)', 'speedup', 'max deviation'))
+
+with TemporaryDirectory() as tmp:
+    for script, spectrum, options in benchmarks:
+        source = os.path.join(tmp, 'source.jjh5')
+        document(source, spectrum)
+
+        times = {}
+        results = {}
+
+        for dtype in ('float64', 'float32'):
+            target = os.path.join(tmp, dtype + '.jjh5')
+            best = np.inf
+
+            for _ in range(args.repeats):
+                copyfile(source, target)
+
+                # noise_reduction.py takes the file name as a positional argument
+                filename = [target] if script == 'noise_reduction.py' else ['-f', target]
+
+                start = perf_counter()
+                subprocess.run([sys.executable, os.path.join(scripts, script)] + filename + options + ['--dtype', dtype], \
+                    check=True, stdout=subprocess.DEVNULL)
+                best = min(best, perf_counter() - start)
+
+            times[dtype] = best
+
+            with h5py.File(target, 'r') as f:
+                results[dtype] = f['JasonDocument/DataPoints/0'][()]
+
+        deviation = np.abs(results['float32'] - results['float64']).max() / np.abs(results['float64']).max()
+
+        print('{0:38s} {1:12.3f} {2:12.3f} {3:8.2f} {4:14.1e}'.format(script, times['float64'], times['float32'], \
+            times['float64'] / times['float32'], deviation))
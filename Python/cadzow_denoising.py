@@ -32,9 +32,24 @@
 #   Set "arguments" to the path of the script, specifying the use of a temporary 
 #   file
 #     (e.g. "C:\Users\<username>\.jason\externalNMRProcessing\python\direct_covariance.py -f $TMPFILE")
-#     the -k (--kindex) option truncates the SVD after this number of singular values
+#     the -k (--kindex) option truncates the SVD after this number of singular values, or
+#       "auto" to pick it from the largest gap in the first iteration's singular values
+#     the --kmax option sets how many singular values are examined by "-k auto", default = 32
 #     the -i (--itr) option sets the number of smoothing iterations to apply, default = 2
 #     the -p (--plot) option plots the signular values to help determine the truncation index
+#     the --svd option selects the SVD backend: full, partial (ARPACK top-k), randomized, or
+#       auto (default), which uses partial whenever k is much smaller than the matrix size
+#     the --check option compares each truncated reconstruction against the full SVD
+#     the -m (--matfree) option never builds the Hankel matrix, using FFT based products with
+#       a truncated SVD backend so memory scales with n*k rather than n^2 (for long FIDs)
+#     the -w (--workers) option sets the number of processes used to denoise the rows of an
+#       arrayed (pseudo-2D) dataset, default = number of CPUs
+#
+#   For a 1D FID, the original FID and the first iteration's singular values and vectors are stored
+#   in the document under JasonDocument/Cadzow. A rerun on the denoised document (e.g. with a
+#   different -k) starts again from that original FID and its stored SVD rather than a fresh SVD
+#
+#   For an arrayed (pseudo-2D) dataset every F1 row is denoised independently
 #     
 #  Set "Data file" to "Spectrum as JJH5"
 #
@@ -44,90 +59,402 @@
 #  Concepts in Magnetic Resonance, 14(6), (2002), 388-401
 #
 
+import os
 import h5py
+import hashlib
 from argparse import ArgumentParser
+from multiprocessing import Pool
+from time import perf_counter
 
 import numpy as np
-from scipy.linalg import diagsvd, hankel, svd
+from scipy.fft import fft, ifft, next_fast_len
+from scipy.linalg import hankel, qr, svd
+from scipy.sparse.linalg import LinearOperator, aslinearoperator, svds
+
+def antidiagonal_counts(l, m):
+    """Number of elements on each anti-diagonal of an l x m matrix"""
+
+    n = l + m - 1
+    idx = np.arange(n)
+
+    return np.minimum(np.minimum(idx + 1, n - idx), min(l, m))
+
+
+def hankelize(S):
+    """Restore the Hankel structure of S by averaging its anti-diagonals.
+
+    Element S[i, j] belongs to point i + j of the signal, so row i of S is
+    added onto points i to i + m - 1 in turn. No index or copy of S is
+    needed, only the signal itself. Returns a complex signal of length
+    l + m - 1.
+    """
+
+    l, m = S.shape
+    signal = np.zeros(l + m - 1, dtype=complex)
+
+    for i in range(l):
+        signal[i:i + m] += S[i]
+
+    return signal / antidiagonal_counts(l, m)
+
+
+def hankelize_factors(U, sigma, V):
+    """Anti-diagonal average of U.diag(sigma).V without forming the product.
 
-import matplotlib.pyplot as plt
+    Each anti-diagonal sum of the rank-k matrix is the sum over components
+    of the convolution of a left and a right singular vector, so all of
+    them are obtained from one batch of FFTs of length ~n.
+    """
 
+    l = U.shape[0]
+    m = V.shape[1]
+    n = l + m - 1
+    nfft = next_fast_len(n)
 
-# Parse the commandline arguments
+    spectra = fft(U, nfft, axis=0) * sigma * fft(V.T, nfft, axis=0)
+    sums = ifft(spectra.sum(axis=1), nfft)[:n]
 
-parser = ArgumentParser()
-parser.add_argument("-f", "--filename", action="store")
-parser.add_argument("-k", "--kindex", action="store", type=int)
-parser.add_argument("-i", "--itr", action="store", type=int, default=2)
-parser.add_argument("-p", "--plot", action="store_true")
+    return sums / antidiagonal_counts(l, m)
 
-args = parser.parse_args()
 
+def hankel_operator(signal, l):
+    """Matrix-free equivalent of hankel(signal[:l], signal[l-1:]).
 
-# Open a file handle for the Jason datafile
+    Products with the Hankel matrix are correlations with the signal,
+    evaluated by FFT. A circular transform of length >= n is enough as
+    the wrapped terms only fall on outputs that are discarded.
+    """
 
-f = h5py.File(args.filename, "r+")
-print('Opening dataset: ', args.filename)
+    n = len(signal)
+    m = n - l + 1
+    nfft = next_fast_len(n)
 
+    X = fft(signal, nfft)
+    Xc = fft(signal.conj(), nfft)
 
-# Read the spectrum
+    def matmat(V):
+        V = V.reshape(m, -1)
+        prod = ifft(X[:, None] * fft(V[::-1], nfft, axis=0), axis=0)
+        return prod[m-1:n, :]
 
-dataset_real = f['JasonDocument/DataPoints/0'][()]
-dataset_imag = f['JasonDocument/DataPoints/1'][()]
-dataset = dataset_real + dataset_imag * 1j
+    def rmatmat(U):
+        U = U.reshape(l, -1)
+        prod = ifft(Xc[:, None] * fft(U[::-1], nfft, axis=0), axis=0)
+        return prod[l-1:n, :]
 
+    return LinearOperator((l, m), dtype=complex,
+        matvec=lambda v: matmat(v).ravel(), rmatvec=lambda u: rmatmat(u).ravel(),
+        matmat=matmat, rmatmat=rmatmat)
 
-# Apply the Cadzow denoising algorithm
 
-if not args.itr % 2 != 1 or args.itr < 1:
-    raise TypeError("number of iterations must be a positive even number")
+def select_rank(sigma):
+    """Rank at the largest gap in the (logarithmic) singular value spectrum"""
 
-n = len(dataset)
-l = int(n / 2.0)
-k = args.kindex
+    sigma = np.maximum(sigma, np.finfo(float).tiny)
 
-dataset_denoised = dataset.copy()
+    return int(np.argmax(np.log(sigma[:-1] / sigma[1:]))) + 1
 
-for it in range(args.itr):
-    # Construct a Hankel matrix from the appropriately partitioned
-    # input signal and calculate its SVD
 
-    S = hankel(dataset_denoised[:l], dataset_denoised[l-1:])
+def svd_full(S, k):
+    """Top-k singular triplets taken from a full SVD of S"""
+
     U, sigma, V = svd(S, full_matrices=False)
 
+    return U[:, :k], sigma[:k], V[:k, :]
+
+
+def svd_partial(S, k):
+    """Top-k singular triplets from the ARPACK (implicitly restarted Lanczos) solver"""
+
+    U, sigma, V = svds(S, k=k)
+    order = np.argsort(sigma)[::-1]
+
+    return U[:, order], sigma[order], V[order, :]
+
+
+def svd_randomized(S, k, oversample=10, power_itr=2):
+    """Top-k singular triplets from a randomized range finder.
+
+    The range of S is sampled with k + oversample random vectors and
+    sharpened by power_itr power iterations, re-orthonormalising after
+    every product. The small projected matrix Q^H.S is then decomposed
+    exactly.
+    """
+
+    A = aslinearoperator(S)
+    p = min(k + oversample, min(A.shape))
+
+    rng = np.random.default_rng()
+    omega = rng.standard_normal((A.shape[1], p)) + 1j * rng.standard_normal((A.shape[1], p))
+
+    Q, _ = qr(A.matmat(omega), mode='economic')
+
+    for _ in range(power_itr):
+        Q, _ = qr(A.rmatmat(Q), mode='economic')
+        Q, _ = qr(A.matmat(Q), mode='economic')
+
+    B = A.rmatmat(Q).conj().T
+    Ub, sigma, V = svd(B, full_matrices=False)
+
+    return np.dot(Q, Ub[:, :k]), sigma[:k], V[:k, :]
+
+
+svd_backends = {
+    'full': svd_full,
+    'partial': svd_partial,
+    'randomized': svd_randomized,
+}
+
+
+def cadzow(signal, k, itr, method, nsv, matfree=False, check=False, plot=False, cached=None):
+    """Cadzow denoising of a single complex FID.
+
+    k may be None to select the rank from the first iteration's singular
+    values. Returns the denoised signal, the first iteration's (U, sigma, V)
+    truncated to nsv components, and the rank that was used.
+    """
+
+    n = len(signal)
+    l = int(n / 2.0)
+
+    denoised = signal.copy()
+
+    for it in range(itr):
+        # Construct a Hankel matrix (or its matrix-free operator) from the
+        # appropriately partitioned input signal and calculate its SVD. The full
+        # singular value spectrum is needed if it is to be plotted
+
+        start = perf_counter()
+
+        if it == 0 and cached is not None:
+            U, sigma, V = cached
+            print('Iteration 1: reusing stored SVD')
+
+        else:
+            if matfree:
+                S = hankel_operator(denoised, l)
+            else:
+                S = hankel(denoised[:l], denoised[l-1:])
+
+            if it == 0 and plot and not matfree:
+                used = 'full'
+                U, sigma, V = svd(S, full_matrices=False)
+            else:
+                used = method
+                U, sigma, V = svd_backends[method](S, nsv if it == 0 else k)
+
+            print('Iteration {it}: {method} SVD took {time:.3f} s'.format(
+                it=it + 1, method=used, time=perf_counter() - start))
+
+
+        # Keep the first iteration's decomposition, and use it to plot the
+        # singular values and/or choose the cut off index k
+
+        if it == 0:
+            first_svd = (U[:, :nsv], sigma, V[:nsv, :])
+
+            if plot:
+                import matplotlib.pyplot as plt
+
+                plt.figure(0)
+                plt.plot(sigma)
+                plt.xlabel('index, i')
+                plt.ylabel('Singular Value, s_i')
+                plt.title('Singular Value Spectrum for Cadzow denoising')
+                plt.show()
+
+            if k is None:
+                k = select_rank(sigma[:nsv])
+                print('Selected k = {k}'.format(k=k))
+
+            U, sigma, V = U[:, :k], sigma[:k], V[:k, :]
+
+
+        # If requested, report how far the truncated reconstruction is from
+        # the one given by the full SVD
+
+        if check:
+            S_clean = np.dot(U * sigma, V)
+
+            start = perf_counter()
+            U_ref, sigma_ref, V_ref = svd_full(hankel(denoised[:l], denoised[l-1:]), k)
+            S_ref = np.dot(U_ref * sigma_ref, V_ref)
+            print('    full SVD took {time:.3f} s, relative reconstruction error {err:.3e}'.format(
+                time=perf_counter() - start,
+                err=np.linalg.norm(S_clean - S_ref) / np.linalg.norm(S_ref)))
+
+
+        # Apply the threshold at index k, rebuilding a "cleaned" matrix, and
+        # average the anti-diagonals to restore its Hankel structure in a new
+        # signal array. The matrix-free path works directly on the factors
+
+        if matfree:
+            denoised = hankelize_factors(U, sigma, V)
+        else:
+            denoised = hankelize(np.dot(U * sigma, V))
+
+    return denoised, first_svd, k
+
+
+def denoise_row(task):
+    """Worker for arrayed datasets, task = (row index, FID, cadzow arguments)"""
+
+    row, signal, options = task
+    denoised, _, k = cadzow(signal, **options)
+
+    return row, denoised, k
+
+
+if __name__ == '__main__':
+    # Parse the commandline arguments
+
+    parser = ArgumentParser()
+    parser.add_argument("-f", "--filename", action="store")
+    parser.add_argument("-k", "--kindex", action="store")
+    parser.add_argument("--kmax", action="store", type=int, default=32)
+    parser.add_argument("-i", "--itr", action="store", type=int, default=2)
+    parser.add_argument("-p", "--plot", action="store_true")
+    parser.add_argument("--svd", action="store", default="auto", choices=["auto"] + list(svd_backends))
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("-m", "--matfree", action="store_true")
+    parser.add_argument("-w", "--workers", action="store", type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+
+
+    # Open a file handle for the Jason datafile
+
+    f = h5py.File(args.filename, "r+")
+    print('Opening dataset: ', args.filename)
+
+
+    # Read the spectrum, arrayed experiments have one FID per F1 row
+
+    dataset_real = f['JasonDocument/DataPoints/0'][()]
+    dataset_imag = f['JasonDocument/DataPoints/1'][()]
+    dataset = dataset_real + dataset_imag * 1j
+
+    length = f['JasonDocument'].attrs['Length']
+    arrayed = len(length) > 1 and length[1] > 1
+
+    if arrayed:
+        dataset = dataset.reshape(length[1], length[0])
+
+
+    # Apply the Cadzow denoising algorithm
+
+    if not args.itr % 2 != 1 or args.itr < 1:
+        raise TypeError("number of iterations must be a positive even number")
+
+    n = dataset.shape[-1]
+    l = int(n / 2.0)
+
+
+    # With "-k auto" the rank is chosen from the first kmax singular values of
+    # the first iteration, otherwise those are only kept for later reruns
+
+    k = None if args.kindex == 'auto' else int(args.kindex)
+    nsv = args.kmax if k is None else max(k, args.kmax)
+    nsv = min(nsv, l - 1)
+
+
+    # Only the first k singular triplets are used, so unless k is a sizeable
+    # fraction of the matrix a truncated solver avoids the O(n^3) full SVD
+
+    method = args.svd
+
+    if method == 'auto':
+        method = 'partial' if 10 * nsv <= l else 'full'
+
+    if method != 'full' and k is not None and k >= l:
+        raise ValueError("truncated SVD backends require k to be less than n/2")
+
+    if args.matfree and method == 'full':
+        raise ValueError("matrix-free mode requires a truncated SVD backend")
+
+    options = dict(k=k, itr=args.itr, method=method, nsv=nsv, matfree=args.matfree, check=args.check)
+
+
+    if arrayed:
+        # Denoise each row independently, spreading the rows over a pool of
+        # worker processes and writing each result into its row of the
+        # (preallocated) output datasets as soon as it is ready. The outputs
+        # are kept 2D whatever the layout of the input, and only replace it
+        # once every row has been written
+
+        print('Denoising {rows} rows with {workers} workers'.format(rows=dataset.shape[0], workers=args.workers))
+
+        out_real = f.create_dataset('/JasonDocument/DataPoints/0_cadzow', shape=dataset.shape, dtype=dataset_real.dtype)
+        out_imag = f.create_dataset('/JasonDocument/DataPoints/1_cadzow', shape=dataset.shape, dtype=dataset_imag.dtype)
+
+        tasks = ((i, dataset[i], options) for i in range(dataset.shape[0]))
+
+        if args.workers > 1:
+            pool = Pool(args.workers)
+            results = pool.imap_unordered(denoise_row, tasks)
+        else:
+            pool = None
+            results = map(denoise_row, tasks)
+
+        for row, denoised, row_k in results:
+            out_real[row] = denoised.real
+            out_imag[row] = denoised.imag
+            print('Row {row} denoised with k = {k}'.format(row=row, k=row_k))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        del f['/JasonDocument/DataPoints/0']
+        del f['/JasonDocument/DataPoints/1']
+        f.move('/JasonDocument/DataPoints/0_cadzow', '/JasonDocument/DataPoints/0')
+        f.move('/JasonDocument/DataPoints/1_cadzow', '/JasonDocument/DataPoints/1')
+
+    else:
+        # Look for a decomposition of this same input stored by an earlier run.
+        # If the data is still the output of that run, denoise its original
+        # input again instead of the denoised FID
+
+        input_hash = hashlib.sha1(dataset.tobytes()).hexdigest()
+        cached = None
+
+        if 'JasonDocument/Cadzow' in f:
+            cache = f['JasonDocument/Cadzow']
+
+            if cache.attrs.get('OutputHash') == input_hash:
+                print('Denoising the original FID stored by an earlier run')
+                dataset = cache['Input'][()]
+                input_hash = cache.attrs['InputHash']
 
-    # If reqested, plot the singular values for the first iteration to
-    # aid in the choice of the cut off index k
+            if cache.attrs['InputHash'] == input_hash and cache['U'].shape[1] >= (k or 1):
+                cached = (cache['U'][()], cache['SingularValues'][()], cache['V'][()])
 
-    if args.plot and (it == 0):
-        plt.figure(0)
-        plt.plot(sigma)
-        plt.xlabel('index, i')
-        plt.ylabel('Singular Value, s_i')
-        plt.title('Singular Value Spectrum for Cadzow denoising')
-        plt.show()
+        dataset_denoised, first_svd, k = cadzow(dataset, plot=args.plot, cached=cached, **options)
 
 
-    # Apply the threshold at index k, rebuilding a "cleaned" matrix
-    # Flip left-right to allow easy access to antidiagonals
+        # Store the input and the first iteration's decomposition for reuse by
+        # later runs, with the hash of the output as the next run will read it
 
-    S = np.dot(np.dot(U[:, :k], diagsvd(1.0 / sigma[:k], k, k)), V[:k, :])
-    S = np.fliplr(S)
+        written = dataset_denoised.real + dataset_denoised.imag * 1j
 
+        if 'JasonDocument/Cadzow' in f:
+            del f['JasonDocument/Cadzow']
 
-    # Average the diagonals to restore the Hankel structure of the
-    # "cleaned" matrix, and store in a new signal array
+        cache = f.create_group('JasonDocument/Cadzow')
+        cache.attrs['InputHash'] = input_hash
+        cache.attrs['OutputHash'] = hashlib.sha1(written.tobytes()).hexdigest()
+        cache.create_dataset('Input', data=dataset)
+        cache.create_dataset('SingularValues', data=first_svd[1])
+        cache.create_dataset('U', data=first_svd[0])
+        cache.create_dataset('V', data=first_svd[2])
 
-    for i in range(n):
-        j = n - l - i
-        dataset_denoised[i] = sum(np.diag(S, k=j)) / len(np.diag(S, k=j))
 
+        # Write back the processed dataset#
 
-# Write back the processed dataset#
+        del f['/JasonDocument/DataPoints/0']
+        del f['/JasonDocument/DataPoints/1']
+        f.create_dataset('/JasonDocument/DataPoints/0', data=dataset_denoised.real)
+        f.create_dataset('/JasonDocument/DataPoints/1', data=dataset_denoised.imag)
 
-del f['/JasonDocument/DataPoints/0']
-del f['/JasonDocument/DataPoints/1']
-f.create_dataset('/JasonDocument/DataPoints/0', data=dataset_denoised.real)
-f.create_dataset('/JasonDocument/DataPoints/1', data=dataset_denoised.imag)
-print('Dataset changed')
-f.close()
+    print('Dataset changed')
+    f.close()
@@ -0,0 +1,218 @@
+#!python3
+
+# -------------------------------------------------------------------------------
+# --
+# -- JEOL Ltd.
+# -- 1-2 Musashino 3-Chome
+# -- Akishima Tokyo 196-8558 Japan
+# --
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# --++---------------------------------------------------------------------------
+# --
+# -- ModuleName : covariance.py
+# -- ModuleType : Support module for the example external command scripts for JASON
+# -- Purpose : Factored covariance matrices for covariance processing
+# -- Language : Python
+# --
+# --##---------------------------------------------------------------------------
+#
+# Covariance matrices held as factors, for use by direct_covariance.py and
+# indirect_covariance.py
+#
+# The covariance S*S.T of a data matrix S = U*diag(s)*V.T, or its square
+# root, is U*diag(s^p)*U.T, with p = 2 for the covariance and p = 1 for the
+# square root. It is kept as the pair (vectors, values) = (U, s^p), truncated
+# to the leading singular components if required, and only expanded to the
+# dense N x N matrix a block of rows at a time. The factors can be stored in
+# the document under JasonDocument/Covariance, as Vectors (N x k) and Values
+# (k), and expanded later. The group also records which covariance the
+# factors are for (Orientation, 'direct' for V from S.T*S or 'indirect' for U
+# from S*S.T), the power of S.T*S or S*S.T they give (Power) and the shape of
+# the spectrum they came from (Shape), so that they are only expanded by the
+# same script on the same spectrum.
+#
+# For data too large to hold in memory, the factors can also be accumulated
+# from blocks of S read from the file in turn (see sketch and prefetch).
+#
+# The unsymmetrical covariance A*B.T of two spectra sharing their columns is
+# accumulated over blocks of those columns (see cross_product), with the
+# inputs memory-mapped where the file layout allows (see open_array). Its
+# power (A*B.T)^p = U*diag(s^p)*V.T is kept as the factors (U, s^p), with
+# the right-hand vectors V passed alongside.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.linalg import svd
+
+
+def factors(S, rank=None, power=1):
+    """Factors (vectors, values) of (S*S.T)^(power/2) from the thin SVD of S"""
+
+    u, s, _ = svd(S, full_matrices=False)
+
+    if rank is not None:
+        u, s = u[:, :rank], s[:rank]
+
+    return u, s**power
+
+
+def sketch(blocks, rank=None):
+    """Factors (U, s) of S*S.T accumulated from the column blocks of S in turn.
+
+    Each block is merged with the sketch U*diag(s) of the blocks before it
+    by a thin SVD, so only the sketch and one block are held at a time.
+    Without a rank limit the result matches the SVD of the whole of S to
+    rounding. With one, the sketch is truncated after each block to twice
+    the rank, which keeps most of the components that only become leading
+    later on, and to the rank itself at the end.
+    """
+
+    u = s = None
+
+    for block in blocks:
+        merged = block if u is None else np.hstack((u * s, block))
+        u, s, _ = svd(merged, full_matrices=False)
+
+        if rank is not None:
+            u, s = u[:, :2 * rank], s[:2 * rank]
+
+    if rank is not None:
+        u, s = u[:, :rank], s[:rank]
+
+    return u, s
+
+
+def prefetch(read, starts):
+    """Yield read(start) for each start in turn, reading the next block on a
+    background thread while the current one is in use"""
+
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        current = None
+
+        for start in starts:
+            following = reader.submit(read, start)
+
+            if current is not None:
+                yield current.result()
+
+            current = following
+
+        if current is not None:
+            yield current.result()
+
+
+def open_array(dataset):
+    """The dataset as a read-only memory-mapped array when it is stored
+    contiguously in the file, otherwise the dataset itself (read a block at
+    a time by h5py)"""
+
+    offset = dataset.id.get_offset()
+
+    if offset is None or dataset.chunks is not None:
+        return dataset
+
+    return np.memmap(dataset.file.filename, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+
+def cross_product(A, B, block_cols=256, dtype=float):
+    """A*B.T in the given precision, accumulated over blocks of the shared
+    columns, the next blocks being read while the current ones are multiplied"""
+
+    read = lambda i: (np.array(A[:, i:i + block_cols], dtype=dtype), np.array(B[:, i:i + block_cols], dtype=dtype))
+
+    C = np.zeros((A.shape[0], B.shape[0]), dtype=dtype)
+
+    for a, b in prefetch(read, range(0, A.shape[1], block_cols)):
+        C += np.dot(a, b.T)
+
+    return C
+
+
+def cross_factors(C, rank=None, power=1):
+    """Factors (vectors, values, right) of C^power = U*diag(s^power)*V.T from
+    the thin SVD of C"""
+
+    u, s, vt = svd(C, full_matrices=False)
+
+    if rank is not None:
+        u, s, vt = u[:, :rank], s[:rank], vt[:rank]
+
+    return u, s**power, vt.T
+
+
+def expand(vectors, values, start=0, stop=None, right=None):
+    """Rows start:stop of the dense matrix vectors*diag(values)*right.T,
+    with right = vectors by default"""
+
+    if right is None:
+        right = vectors
+
+    return np.dot(vectors[start:stop] * values, right.T)
+
+
+def save_factors(f, vectors, values, orientation, power):
+    """Store the factors in the document, replacing any stored before, with
+    the covariance they came from ('direct' or 'indirect'), its power and the
+    shape of the spectrum they were calculated from"""
+
+    if 'JasonDocument/Covariance' in f:
+        del f['JasonDocument/Covariance']
+
+    group = f.create_group('JasonDocument/Covariance')
+    group.create_dataset('Vectors', data=vectors)
+    group.create_dataset('Values', data=values)
+    group.attrs['Rank'] = len(values)
+    group.attrs['Orientation'] = orientation
+    group.attrs['Power'] = power
+    group.attrs['Shape'] = f['JasonDocument/DataPoints/0'].shape
+
+
+def load_factors(f, orientation):
+    """Factors stored in the document by save_factors, with their power.
+
+    Raises ValueError unless they were stored for the given covariance
+    ('direct' or 'indirect') from a spectrum of the shape now in the document.
+    """
+
+    group = f['JasonDocument/Covariance']
+
+    stored = group.attrs.get('Orientation')
+    if stored != orientation:
+        raise ValueError('the stored factors are not from ' + orientation + ' covariance' + \
+            ('' if stored is None else ' (they are from ' + str(stored) + ' covariance)'))
+
+    shape = tuple(int(n) for n in group.attrs['Shape'])
+    if shape != f['JasonDocument/DataPoints/0'].shape:
+        raise ValueError('the stored factors are from a spectrum of shape ' + str(shape) + \
+            ', not ' + str(f['JasonDocument/DataPoints/0'].shape))
+
+    return group['Vectors'][()], group['Values'][()], group.attrs['Power']
+
+
+def write_dense(f, vectors, values, block_rows=256, right=None):
+    """Replace the spectrum with the dense matrix, expanded and written a
+    block of rows at a time into a dataset chunked by the same blocks"""
+
+    if right is None:
+        right = vectors
+
+    n, m = vectors.shape[0], right.shape[0]
+
+    del f['/JasonDocument/DataPoints/0']
+    covar = f.create_dataset('/JasonDocument/DataPoints/0', shape=(n, m), dtype=vectors.dtype, \
+        chunks=(min(block_rows, n), m))
+
+    for i in range(0, n, block_rows):
+        covar[i:i + block_rows] = expand(vectors, values, i, i + block_rows, right)
@@ -34,7 +34,17 @@
 #   Set "arguments" to the path of the script, specifying the use of a temporary 
 #   file
 #     (e.g. "C:\Users\<username>\.jason\externalNMRProcessing\python\direct_covariance.py -f $TMPFILE")
-#     use the -n (--nosqrt) flag to not perform the matrix square root operation, which is typically quite slow
+#     use the -n (--nosqrt) flag to not perform the matrix square root operation
+#     use the -k (--rank) flag to keep only the k largest singular components of the data, which suppresses noise
+#     use the --factors flag to store the result in the document as factors (JasonDocument/Covariance) rather
+#       than as the dense spectrum, which is left unchanged, e.g. for a large rank-limited covariance
+#     use the --expand flag to replace the spectrum with the dense covariance from factors stored by --factors
+#       of this script on the same spectrum
+#     use the -b flag to set the number of rows of the dense covariance computed at a time (default 256)
+#     use the --dtype flag to set the precision the covariance is computed and stored in, float64 (default) or float32
+#     use the --stream flag to read the spectrum from the file a block of rows at a time (-b sets the size), so
+#       only the factors and one block are held in memory, with the next block read while the current one
+#       is processed
 #     
 #  Set "Data file" to "Spectrum as JJH5"
 #
@@ -45,7 +55,8 @@ import h5py
 from argparse import ArgumentParser
 
 import numpy as np
-from scipy.linalg import sqrtm
+
+from covariance import factors, sketch, prefetch, save_factors, load_factors, write_dense
 
 
 # Parse the commandline arguments
@@ -53,6 +64,12 @@ from scipy.linalg import sqrtm
 parser = ArgumentParser()
 parser.add_argument("-f", "--filename", action="store")
 parser.add_argument("-n", "--nosqrt", action="store_false")
+parser.add_argument("-k", "--rank", action="store", type=int)
+parser.add_argument("--factors", action="store_true")
+parser.add_argument("--expand", action="store_true")
+parser.add_argument("-b", "--block-rows", action="store", type=int, default=256)
+parser.add_argument("--stream", action="store_true")
+parser.add_argument("--dtype", action="store", default="float64", choices=["float64", "float32"])
 args = parser.parse_args()
 
 
@@ -62,9 +79,14 @@ f = h5py.File(args.filename, "r+")
 print('Opening dataset: ', args.filename)
 
 
-# Read the real part of the spectrum
+# Read the real part of the spectrum, unless expanding stored factors
+# When streaming, the spectrum is left in the file and read a block at a time
+
+if not args.expand:
+    dataset = f['JasonDocument/DataPoints/0'].astype(args.dtype)
 
-dataset = f['JasonDocument/DataPoints/0'][()]
+    if not args.stream:
+        dataset = dataset[()]
 
 
 # Get some parameters associated with the spectrum
@@ -76,30 +98,54 @@ spec_ref = f['JasonDocument/SpecInfo'].attrs['SpectrumRef']
 
 
 # Calculate the direct covariance, sqrt(S.T*S)
-#  note that sqrtm from SciPy is quite slow (2k x 2k takes ~30s)
-
-covar = np.dot(dataset.T, dataset)
-
-if args.nosqrt:
-    covar = sqrtm(covar)
-    covar = covar.real
-
-
-# Update parameters
-
-length[1] = covar.shape[0]
-sw[1] = sw[0]
-spec_freq[1] = spec_freq[0]
-spec_ref[1] = spec_ref[0]
-f['JasonDocument/'].attrs.modify('Length', length)
-f['JasonDocument/SpecInfo'].attrs.modify('SW', sw)
-f['JasonDocument/SpecInfo'].attrs.modify('SpectrometerFrequencies', spec_freq)
-f['JasonDocument/SpecInfo'].attrs.modify('SpectrumRef', spec_ref)
-
-
-# Write back the processed dataset#
+#  the square root comes from the thin SVD S = U*diag(s)*V.T, as
+#  sqrt(S.T*S) = V*diag(s)*V.T, without forming S.T*S itself, and is
+#  kept as the factors (V, s) until written out
+#  the factors of S.T*S itself, (V, s^2), are used when it is rank limited, stored or streamed
+
+vectors = None
+
+if args.expand:
+    try:
+        vectors, values, power = load_factors(f, 'direct')
+    except ValueError as error:
+        parser.error(str(error))
+    print('Expanding stored covariance factors of rank ', len(values), ' and power ', power)
+elif args.stream:
+    nrows = f['JasonDocument/DataPoints/0'].shape[0]
+    blocks = prefetch(lambda i: dataset[i:i + args.block_rows].T, range(0, nrows, args.block_rows))
+    vectors, values = sketch(blocks, args.rank)
+    values = values if args.nosqrt else values**2
+elif args.nosqrt or args.rank is not None or args.factors:
+    vectors, values = factors(dataset.T, args.rank, 1 if args.nosqrt else 2)
+else:
+    covar = np.dot(dataset.T, dataset)
+
+if args.factors:
+    save_factors(f, vectors, values, 'direct', 0.5 if args.nosqrt else 1.0)
+    print('Covariance factors of rank ', len(values), ' stored')
+
+else:
+    # Update parameters
+
+    n = covar.shape[0] if vectors is None else vectors.shape[0]
+    length[1] = n
+    sw[1] = sw[0]
+    spec_freq[1] = spec_freq[0]
+    spec_ref[1] = spec_ref[0]
+    f['JasonDocument/'].attrs.modify('Length', length)
+    f['JasonDocument/SpecInfo'].attrs.modify('SW', sw)
+    f['JasonDocument/SpecInfo'].attrs.modify('SpectrometerFrequencies', spec_freq)
+    f['JasonDocument/SpecInfo'].attrs.modify('SpectrumRef', spec_ref)
+
+
+    # Write back the processed dataset#
+
+    if vectors is None:
+        del f['/JasonDocument/DataPoints/0']
+        f.create_dataset('/JasonDocument/DataPoints/0', data=covar)
+    else:
+        write_dense(f, vectors, values, args.block_rows)
+    print('Dataset changed')
 
-del f['/JasonDocument/DataPoints/0']
-f.create_dataset('/JasonDocument/DataPoints/0', data=covar)
-print('Dataset changed')
 f.close()
@@ -34,7 +34,25 @@
 #   Set "arguments" to the path of the script, specifying the use of a temporary 
 #   file
 #     (e.g. "C:\Users\<username>\.jason\externalNMRProcessing\python\indirect_covariance.py -f $TMPFILE")
-#     use the -n (--nosqrt) flag to not perform the matrix square root operation, which is typically quite slow
+#     use the -n (--nosqrt) flag to not perform the matrix square root operation
+#     use the -k (--rank) flag to keep only the k largest singular components of the data, which suppresses noise
+#     use the --factors flag to store the result in the document as factors (JasonDocument/Covariance) rather
+#       than as the dense spectrum, which is left unchanged, e.g. for a large rank-limited covariance
+#     use the --expand flag to replace the spectrum with the dense covariance from factors stored by --factors
+#       of this script on the same spectrum
+#     use the -b flag to set the number of rows of the dense covariance computed at a time (default 256)
+#     use the --dtype flag to set the precision the covariance is computed and stored in, float64 (default) or float32
+#     use the --stream flag to read the spectrum from the file a block of columns at a time (-b sets the size), so
+#       only the factors and one block are held in memory, with the next block read while the current one
+#       is processed
+#     use the -p (--power) flag to raise the covariance to another power than the square root (default 0.5,
+#       or 1.0 with -n)
+#
+#     Unsymmetrical covariance: use the -g (--second) flag to give a second document sharing the F2 dimension
+#       with the first (e.g. HSQC and TOCSY), e.g. -f $TMPFILE -g tocsy.jjh5
+#     the covariance A*B.T of the two spectra, raised to the power, replaces the first spectrum, with the F1
+#       dimension of the second document as its new F2 dimension
+#     both spectra are read straight from the files (memory-mapped where possible) a block of -b columns at a time
 #     
 #  Set "Data file" to "Spectrum as JJH5"
 #
@@ -45,7 +63,9 @@ import h5py
 from argparse import ArgumentParser
 
 import numpy as np
-from scipy.linalg import sqrtm
+
+from covariance import factors, sketch, prefetch, open_array, cross_product, cross_factors, \
+    save_factors, load_factors, write_dense
 
 
 # Parse the commandline arguments
@@ -53,8 +73,22 @@ from scipy.linalg import sqrtm
 parser = ArgumentParser()
 parser.add_argument("-f", "--filename", action="store")
 parser.add_argument("-n", "--nosqrt", action="store_false")
+parser.add_argument("-k", "--rank", action="store", type=int)
+parser.add_argument("--factors", action="store_true")
+parser.add_argument("--expand", action="store_true")
+parser.add_argument("-b", "--block-rows", action="store", type=int, default=256)
+parser.add_argument("--stream", action="store_true")
+parser.add_argument("--dtype", action="store", default="float64", choices=["float64", "float32"])
+parser.add_argument("-p", "--power", action="store", type=float)
+parser.add_argument("-g", "--second", action="store")
 args = parser.parse_args()
 
+if args.power is None:
+    args.power = 0.5 if args.nosqrt else 1.0
+
+if args.second and (args.factors or args.expand):
+    parser.error("--factors and --expand can not be used with a second document")
+
 
 # Open a file handle for the Jason datafile
 
@@ -62,9 +96,25 @@ f = h5py.File(args.filename, "r+")
 print('Opening dataset: ', args.filename)
 
 
-# Read the real part of the spectrum
+# Read the real part of the spectrum, unless expanding stored factors
+# When streaming, the spectrum is left in the file and read a block at a time
+# With a second document, both spectra are memory-mapped where possible
+
+if args.second:
+    g = h5py.File(args.second, "r")
+    print('Opening second dataset: ', args.second)
+
+    dataset = open_array(f['JasonDocument/DataPoints/0'])
+    second = open_array(g['JasonDocument/DataPoints/0'])
+
+    if dataset.shape[1] != second.shape[1]:
+        parser.error("the two spectra must have the same number of F2 points")
+
+elif not args.expand:
+    dataset = f['JasonDocument/DataPoints/0'].astype(args.dtype)
 
-dataset = f['JasonDocument/DataPoints/0'][()]
+    if not args.stream:
+        dataset = dataset[()]
 
 
 # Get some parameters associated with the spectrum
@@ -74,32 +124,74 @@ sw = f['JasonDocument/SpecInfo'].attrs['SW']
 spec_freq = f['JasonDocument/SpecInfo'].attrs['SpectrometerFrequencies']
 spec_ref = f['JasonDocument/SpecInfo'].attrs['SpectrumRef']
 
+# The new F2 dimension is the F1 dimension of the second document, if any,
+# otherwise that of this one
 
-# Calculate the indirect covariance, sqrt(S*S.T)
-#  note that sqrtm from SciPy is quite slow (2k x 2k takes ~30s)
-
-covar = np.dot(dataset, dataset.T)
-
-if args.nosqrt:
-    covar = sqrtm(covar)
-    covar = covar.real
-
+source = g if args.second else f
+source_sw = source['JasonDocument/SpecInfo'].attrs['SW']
+source_spec_freq = source['JasonDocument/SpecInfo'].attrs['SpectrometerFrequencies']
+source_spec_ref = source['JasonDocument/SpecInfo'].attrs['SpectrumRef']
 
-# Update parameters
 
-length[0] = covar.shape[1]
-sw[0] = sw[1]
-spec_freq[0] = spec_freq[1]
-spec_ref[0] = spec_ref[1]
-f['JasonDocument/'].attrs.modify('Length', length)
-f['JasonDocument/SpecInfo'].attrs.modify('SW', sw)
-f['JasonDocument/SpecInfo'].attrs.modify('SpectrometerFrequencies', spec_freq)
-f['JasonDocument/SpecInfo'].attrs.modify('SpectrumRef', spec_ref)
-
-
-# Write back the processed dataset#
+# Calculate the indirect covariance, sqrt(S*S.T)
+#  the square root comes from the thin SVD S = U*diag(s)*V.T, as
+#  sqrt(S*S.T) = U*diag(s)*U.T, without forming S*S.T itself, and is
+#  kept as the factors (U, s) until written out
+#  any other power p of S*S.T has the factors (U, s^2p), which are used when
+#  it is rank limited, stored or streamed
+# With a second document, the unsymmetrical covariance A*B.T is accumulated
+#  over blocks of F2 and any power of it comes from its own thin SVD
+
+vectors = right = None
+
+if args.second:
+    covar = cross_product(dataset, second, args.block_rows, args.dtype)
+    del dataset, second
+    g.close()
+
+    if args.power != 1.0 or args.rank is not None:
+        vectors, values, right = cross_factors(covar, args.rank, args.power)
+elif args.expand:
+    try:
+        vectors, values, power = load_factors(f, 'indirect')
+    except ValueError as error:
+        parser.error(str(error))
+    print('Expanding stored covariance factors of rank ', len(values), ' and power ', power)
+elif args.stream:
+    ncols = f['JasonDocument/DataPoints/0'].shape[1]
+    blocks = prefetch(lambda i: dataset[:, i:i + args.block_rows], range(0, ncols, args.block_rows))
+    vectors, values = sketch(blocks, args.rank)
+    values = values**(2 * args.power)
+elif args.power != 1.0 or args.rank is not None or args.factors:
+    vectors, values = factors(dataset, args.rank, 2 * args.power)
+else:
+    covar = np.dot(dataset, dataset.T)
+
+if args.factors:
+    save_factors(f, vectors, values, 'indirect', args.power)
+    print('Covariance factors of rank ', len(values), ' stored')
+
+else:
+    # Update parameters
+
+    n = covar.shape[1] if vectors is None else (vectors if right is None else right).shape[0]
+    length[0] = n
+    sw[0] = source_sw[1]
+    spec_freq[0] = source_spec_freq[1]
+    spec_ref[0] = source_spec_ref[1]
+    f['JasonDocument/'].attrs.modify('Length', length)
+    f['JasonDocument/SpecInfo'].attrs.modify('SW', sw)
+    f['JasonDocument/SpecInfo'].attrs.modify('SpectrometerFrequencies', spec_freq)
+    f['JasonDocument/SpecInfo'].attrs.modify('SpectrumRef', spec_ref)
+
+
+    # Write back the processed dataset#
+
+    if vectors is None:
+        del f['/JasonDocument/DataPoints/0']
+        f.create_dataset('/JasonDocument/DataPoints/0', data=covar)
+    else:
+        write_dense(f, vectors, values, args.block_rows, right)
+    print('Dataset changed')
 
-del f['/JasonDocument/DataPoints/0']
-f.create_dataset('/JasonDocument/DataPoints/0', data=covar)
-print('Dataset changed')
 f.close()
@@ -34,9 +34,21 @@
 # algorithm is from J. Biomol. NMR, 2 (1992) 485-494
 # 
 # NOTE: data must be baseline corrected prior to use
+#
+# Usage: noise_reduction.py $TMPFILE [--stream] [--block-rows <N>] [--threads <N>] [--dtype float32]
+#   the --stream option processes the spectrum in blocks straight from and to the file, so memory
+#     use is bounded by the block size rather than the size of the spectrum (for large 2D spectra)
+#   the --block-rows option sets the number of rows processed together, default = 256
+#   the --threads option sets the number of threads smoothing blocks of rows in parallel, default = 1
+#   the --dtype option sets the precision the spectrum is processed and stored in, float64 (default)
+#     or float32, which halves the memory use and file size
 
-import sys
 import h5py
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from time import perf_counter
 
 import numpy as np
 
@@ -47,113 +59,305 @@ eta = 3.0           # Real-peak threshold (peaks above this level are determined
 itr_stop = 0.01     # Tolerance to stop the ANI iterations (not normally changed)
 T = 10.0            # Smoothing threshold (low values give stronger t1 noise reduction)
 smooth_itr = 10     # Number of smoothing iterations applied
+max_ani_itr = 100   # Maximum number of ANI iterations for any column
+block_rows = 256    # Number of rows smoothed together (limits the size of the work buffers)
 
 
-# Open a file handle for the Jason datafile
+def column_noise(spec, eta, itr_stop, max_itr):
+    """ANI noise level of every column of spec, computed for all columns at once.
 
-f = h5py.File(sys.argv[1], "r+")
-print('Opening dataset: ', sys.argv[1])
+    The peaks of a column are the maximum absolute values between each pair
+    of zero crossings. The lobes of every column are laid end to end in one
+    flat array, so all of the peaks come from a single np.maximum.reduceat.
+    Real peaks (above eta times the noise) are then removed from all columns
+    together, until the noise level of each column changes by less than
+    itr_stop, or max_itr iterations have been made.
+    """
 
+    cols = np.ascontiguousarray(spec.T)
+    ncols, nrows = cols.shape
 
-# Get the real part of the spectrum
-# Need to swap the number of points around to get the right shape compared to
-# how JASON stores the parameters
 
-real_spec = f['JasonDocument/DataPoints/0'][()]
+    # Find the locations of the zero crossings, a lobe starts one point after
+    # each crossing and is complete if another crossing follows in the same column
 
-npts = real_spec.shape
+    col, crossing = np.nonzero(np.diff(np.signbit(cols), axis=1))
+    starts = col * nrows + crossing + 1
 
-t1red_spec = np.zeros(npts)
+    if starts.size == 0:
+        return np.full(ncols, np.nan)
 
+    peaks = np.maximum.reduceat(np.abs(cols).ravel(), starts)
+    complete = np.append(col[1:] == col[:-1], False)
 
-# Begin the ANI (Average NoIse) routine
+    col = col[complete]
+    A = np.where(np.signbit(cols.ravel()[starts[complete]]), -peaks[complete], peaks[complete])
+    abs_A = np.abs(A)
 
-print('Determining t1 noise profile . . .')
 
-N = np.zeros(npts[1])
+    # Calculate the noise, and remove any real peaks, defined as peaks greater than
+    # eta times the noise level, from every column that has not converged
 
-for i in range(npts[1]):
-    # Loop over each t1 column of the spectrum
-    # Find the locations of the zero crossings
+    keep = np.ones(A.size, dtype=bool)
 
-    zero_crossings = np.where(np.diff(np.signbit(real_spec[:, i])))[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        noise = np.bincount(col, weights=abs_A, minlength=ncols) / np.bincount(col, minlength=ncols)
 
+    N = noise.copy()
+    active = np.isfinite(noise)
 
-    # The peaks are the (abs) maxima between each zero crossing
+    for _ in range(max_itr):
+        keep &= ~active[col] | (A < eta * noise[col])
 
-    A_idx = np.zeros(len(zero_crossings)-1, dtype=int)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_noise = np.bincount(col, weights=abs_A * keep, minlength=ncols) \
+                / np.bincount(col, weights=keep, minlength=ncols)
 
-    for j in range(A_idx.shape[0]-1):
-        A_idx[j] = j + np.abs(real_spec[zero_crossings[j:j+1], i]).argmax()
+        done = active & ~(noise - new_noise >= itr_stop)
+        N[done] = new_noise[done]
 
+        active &= ~done
+        noise = np.where(active, new_noise, noise)
 
-    # Build an array containing the peaks
+        if not active.any():
+            break
 
-    A = real_spec[A_idx, i]
+    N[active] = noise[active]
 
+    return N
 
-    # Calculate the noise, and remove any real peaks, defined as peaks greater than
-    # eta times the noise level
 
-    while True:
-        noise = np.abs(A).sum() / A.size
+def smoothing_stencil(S):
+    """Normalised weights of the three point RT1 smoothing of points 1 to n-2.
 
-        A = A[A < eta * noise]
+    The weights depend only on the smoothing array S, so they are
+    calculated once rather than on every iteration of every row.
+    """
 
-        new_noise = np.abs(A).sum() / A.size
+    w_left = (1.0 - S[1:-1]) * S[:-2]
+    w_centre = 2.0 * S[1:-1]
+    w_right = (1.0 - S[1:-1]) * S[2:]
 
-        if noise - new_noise < itr_stop:
-            N[i] = new_noise
-            break
+    norm = w_left + w_centre + w_right
+
+    # A point with no weight at all (S of zero there and either side) is
+    # left as it is rather than divided by zero
+
+    empty = norm == 0.0
+    w_centre[empty] = 1.0
+    norm[empty] = 1.0
+
+    return w_left / norm, w_centre / norm, w_right / norm
+
+
+def smooth_rows(real, error, stencil, smooth_itr, out, buffers):
+    """Apply the RT1 smoothing to a block of rows, writing the result into out.
+
+    All of the rows in the block are updated together. The work is done
+    in place in the preallocated buffers, five arrays of at least the
+    shape of the block, so no memory is allocated per iteration.
+    """
+
+    nrows = real.shape[0]
+    P, Q, tmp, lower, upper = (buf[:nrows] for buf in buffers)
+    w_left, w_centre, w_right = stencil
+
+
+    # No point may be adjusted by more than the error. Reduce the intensity
+    # of every point by the error, setting points below the error to zero
+
+    np.subtract(real, error, out=lower)
+    np.add(real, error, out=upper)
+
+    np.maximum(lower, 0.0, out=P)
+
+
+    # Apply t1 noise smoothing, checking that no point was adjusted by more than the error
+
+    for j in range(smooth_itr):
+        np.multiply(P[:, :-2], w_left, out=Q[:, 1:-1])
+        np.multiply(P[:, 1:-1], w_centre, out=tmp[:, 1:-1])
+        Q[:, 1:-1] += tmp[:, 1:-1]
+        np.multiply(P[:, 2:], w_right, out=tmp[:, 1:-1])
+        Q[:, 1:-1] += tmp[:, 1:-1]
+
+        Q[:, 0] = 0.0
+        Q[:, -1] = 0.0
+
+        np.clip(Q, lower, upper, out=Q)
+
+        P, Q = Q, P
+
+    # Never write a non-finite point, keep the original value there instead
+
+    bad = ~np.isfinite(P)
+
+    if bad.any():
+        P[bad] = real[bad]
+
+    out[...] = P
+
+
+# Parse the commandline arguments
+
+parser = ArgumentParser()
+parser.add_argument("filename", action="store")
+parser.add_argument("--stream", action="store_true")
+parser.add_argument("--block-rows", action="store", type=int, default=block_rows)
+parser.add_argument("--threads", action="store", type=int, default=1)
+parser.add_argument("--dtype", action="store", default="float64", choices=["float64", "float32"])
+
+args = parser.parse_args()
+
+
+timings = {}
+start = perf_counter()
+
+
+# Open a file handle for the Jason datafile
+
+f = h5py.File(args.filename, "r+")
+print('Opening dataset: ', args.filename)
+
+
+# Get the real part of the spectrum
+# Need to swap the number of points around to get the right shape compared to
+# how JASON stores the parameters
+# When streaming, the spectrum is left in the file and read a block at a time
+
+dataset = f['JasonDocument/DataPoints/0']
+
+npts = dataset.shape
+
+if args.stream:
+    real_spec = dataset
+    t1red_spec = f.create_dataset('/JasonDocument/DataPoints/0_t1red', shape=npts, dtype=args.dtype, \
+        chunks=(min(args.block_rows, npts[0]), npts[1]))
+else:
+    real_spec = dataset.astype(args.dtype)[()]
+    t1red_spec = np.zeros(npts, dtype=args.dtype)
+
+timings['Reading'] = perf_counter() - start
+start = perf_counter()
+
+
+# Begin the ANI (Average NoIse) routine
+# When streaming, this is a single pass over slabs of whole columns, each
+# holding about as many points as a block of rows
+
+print('Determining t1 noise profile . . .')
+
+if args.stream:
+    N = np.zeros(npts[1])
+    block_cols = max(1, args.block_rows * npts[1] // npts[0])
+
+    for i in range(0, npts[1], block_cols):
+        N[i:i + block_cols] = column_noise(real_spec.astype(args.dtype)[:, i:i + block_cols], eta, itr_stop, max_ani_itr)
+
+else:
+    N = column_noise(real_spec, eta, itr_stop, max_ani_itr)
+
+timings['Noise profile'] = perf_counter() - start
+start = perf_counter()
 
 
 # Finally, calculate the error for each t1 point, and some derived quantities
 # The elements of the smoothing array are set to a maximum value of 1.0
 
-error = eta * N
-L = T * error.min()
-S = L / error
-S[S>1.0] = 1.0
+# Columns without a noise level (no complete lobe, e.g. all zero or of a
+# single sign) are left unsmoothed, with no error and S set to 1.0
+
+noisy = np.isfinite(N)
+
+if not noisy.all():
+    print('Columns without a noise level, left unsmoothed: ', np.count_nonzero(~noisy))
+
+error = np.where(noisy, eta * N, 0.0)
+L = T * error[noisy].min() if noisy.any() else 0.0
+
+with np.errstate(divide='ignore', invalid='ignore'):
+    S = L / error
+
+S[~(S <= 1.0)] = 1.0
 
 
 # Begin the RT1 (Reduce T1 noise) routine
 
 print('Applying smoothing . . .')
 
-for i in range(npts[0]):
-    # Loop over each row in the spectrum, taking a copy of that row
+stencil = [w.astype(args.dtype) for w in smoothing_stencil(S)]
+error = error.astype(args.dtype)
 
-    P = real_spec[i, :].copy()
 
+# Each thread takes a set of work buffers from the queue while it smooths a
+# block, so no two blocks share buffers. NumPy releases the GIL during the
+# array operations, so the blocks are processed concurrently
 
-    # Reduce the intensity of every point by the error
+buffer_sets = Queue()
 
-    P[P<error] = 0.0
-    P = np.sign(P) * (np.abs(P) - error)
+for _ in range(args.threads):
+    buffer_sets.put([np.empty((min(args.block_rows, npts[0]), npts[1]), dtype=args.dtype) for _ in range(5)])
 
+def smooth_block(block, out):
+    buffers = buffer_sets.get()
+    smooth_rows(block, error, stencil, smooth_itr, out, buffers)
+    buffer_sets.put(buffers)
 
-    # Apply t1 noise smoothing, checking that no point was adjusted by more than the error
+with ThreadPoolExecutor(max_workers=args.threads) as executor:
+    if args.stream:
+        # Read each block of rows from the file in turn, keeping at most one
+        # block per thread in flight, and write the results back in order
 
-    for j in range(smooth_itr):
-        P = ((1.0 - S[1:-1]) * S[:-2] * P[:-2] + 2.0 * S[1:-1] * P[1:-1] + \
-        (1.0 - S[1:-1]) * S[2:] * P[2:]) / \
-        ((1.0 - S[1:-1]) * S[:-2] + 2.0 * S[1:-1] + (1.0 - S[1:-1]) * S[2:])
+        pending = deque()
+
+        for i in range(0, npts[0], args.block_rows):
+            block = real_spec.astype(args.dtype)[i:i + args.block_rows]
+            out = np.empty(block.shape, dtype=args.dtype)
+            pending.append((i, out, executor.submit(smooth_block, block, out)))
 
-        P = np.append(np.append(0.0, P), 0.0)
+            if len(pending) >= args.threads:
+                j, out, future = pending.popleft()
+                future.result()
+                t1red_spec[j:j + out.shape[0]] = out
 
-        P[P > real_spec[i, :] + error] = real_spec[i, P > real_spec[i, :] + error] + error[P > real_spec[i, :] + error]
-        P[P < real_spec[i, :] - error] = real_spec[i, P < real_spec[i, :] - error] - error[P < real_spec[i, :] - error]
+        for j, out, future in pending:
+            future.result()
+            t1red_spec[j:j + out.shape[0]] = out
 
+    else:
+        # Every block of rows is smoothed straight into its own (disjoint)
+        # slice of the output matrix
 
-    # Add the smoothed row to the output matrix
+        futures = [executor.submit(smooth_block, real_spec[i:i + args.block_rows], \
+            t1red_spec[i:i + args.block_rows]) for i in range(0, npts[0], args.block_rows)]
 
-    t1red_spec[i, :] = P
+        for future in futures:
+            future.result()
+
+timings['Smoothing'] = perf_counter() - start
+start = perf_counter()
 
 
 # Write out the changes to the original file
 
 del f['/JasonDocument/DataPoints/0']
-f.create_dataset('/JasonDocument/DataPoints/0', data=t1red_spec)
-print('Dataset denoised')
+
+if args.stream:
+    f.move('/JasonDocument/DataPoints/0_t1red', '/JasonDocument/DataPoints/0')
+else:
+    f.create_dataset('/JasonDocument/DataPoints/0', data=t1red_spec)
+
 f.close()
 
+timings['Writing'] = perf_counter() - start
+
+
+# Report where the time went
+
+print('Dataset denoised')
+
+for stage, duration in timings.items():
+    print('  {stage:<15s}{duration:8.3f} s'.format(stage=stage, duration=duration))
+
+print('  {stage:<15s}{duration:8.3f} s ({threads} threads)'.format(stage='Total', \
+    duration=sum(timings.values()), threads=args.threads))
@@ -41,6 +41,27 @@
 #     use the -j flag to set the value of the heteronuclear J coupling for satellite of reference signal (default 6.6 Hz TMS)
 #     use the -a flag to set the abundance of the heteronucleus for satellite of reference signal (default 4.67 Hz for 29Si)
 #
+#     Sweep mode: give several values to any of -l, -g, -r and -w (e.g. -l 0.5 1.0 2.0 -w 50 100) to
+#     try every combination of them at once
+#     use the -o flag to select the sweep output: "score" (default) leaves the spectrum unchanged and
+#       reports the linewidth of the reference peak for each setting, "stack" replaces the spectrum
+#       with all of the candidate spectra as a pseudo-2D, one candidate per F1 row in the order of the stored
+#       settings; F1 is a unit-spaced candidate axis (SW = number of candidates in Hz at 1 MHz, so ppm read
+#       as counts), reading n at the first row down to 1 at the last of n candidates
+#     in both cases the settings (and scores) are stored in the document under JasonDocument/ReferenceDeconvolution
+#
+#     Multi-reference mode: use the -m flag to treat the -r values (each with the matching -w value, or a
+#       single -w for all of them) as separate reference signals used together, e.g. -m -r 0.0 7.26 -w 50 
+#     use the --weights flag to give the weight of each reference in the combined correction (default equal weights)
+#     use the --segmented flag to correct each part of the spectrum with the reference closest to it rather
+#       than with the combined correction (the spectrum is split half way between the references)
+#     --weights and --segmented are only used in this mode, and require -m
+#     -l and -g may still be swept in this mode
+#
+#     use the --fft-workers flag to set the number of threads used for the Fourier transforms (default -1, all)
+#     use the --dtype flag to set the precision the spectrum is processed and stored in, float64 (default) or float32
+#       (complex64 for the FIDs)
+#
 #  Set "Data file" to "Spectrum as JJH5"
 #
 # Press "Apply"
@@ -56,46 +77,72 @@
 
 import h5py
 from argparse import ArgumentParser
+from itertools import product
 import numpy as np
-from scipy.fft import fft, ifft, fftshift
+from scipy.fft import fft, rfft, fftshift
 
 # Process commandline options
 parser = ArgumentParser()
 # temporary file name
 parser.add_argument("-f", "--filename", action="store")
-# Lorentzian linewidth
-parser.add_argument("-l", "--lhz", action="store", type=float, default=0.0)
-# Gaussian linewidth
-parser.add_argument("-g", "--ghz", action="store", type=float, default=np.inf)
-# reference signal position in PPM
-parser.add_argument("-r", "--refpos", action="store", type=float, default=0.0)
-# reference region width to use in Hz
-parser.add_argument("-w", "--width", action="store", type=float, default=100.0)
+# Lorentzian linewidth(s)
+parser.add_argument("-l", "--lhz", action="store", type=float, nargs="+", default=[0.0])
+# Gaussian linewidth(s)
+parser.add_argument("-g", "--ghz", action="store", type=float, nargs="+", default=[np.inf])
+# reference signal position(s) in PPM
+parser.add_argument("-r", "--refpos", action="store", type=float, nargs="+", default=[0.0])
+# reference region width(s) to use in Hz
+parser.add_argument("-w", "--width", action="store", type=float, nargs="+", default=[100.0])
 # use satellite doublet for reference signal
 parser.add_argument("-s", "--sat", action="store_true")
 # heteronuclear J-coupling of reference signal 
 parser.add_argument("-j", "--jxy", action="store", type=float, default=6.6)
 # abundance of reference satellite in % 
 parser.add_argument("-a", "--abundance", action="store", type=float, default=4.67)
+# output of a sweep over several settings
+parser.add_argument("-o", "--output", action="store", default="score", choices=["score", "stack"])
+# use all the reference signals together
+parser.add_argument("-m", "--multiref", action="store_true")
+# weights of the reference signals in the combined correction
+parser.add_argument("--weights", action="store", type=float, nargs="+")
+# correct each part of the spectrum with the closest reference signal
+parser.add_argument("--segmented", action="store_true")
+# number of threads used for the Fourier transforms
+parser.add_argument("--fft-workers", action="store", type=int, default=-1)
+# precision of the processing and of the result
+parser.add_argument("--dtype", action="store", default="float64", choices=["float64", "float32"])
 
 args = parser.parse_args()
 
+if not args.multiref and (args.weights is not None or args.segmented):
+    parser.error("--weights and --segmented require -m")
+
+if args.multiref:
+    if len(args.width) not in (1, len(args.refpos)):
+        parser.error("give one width, or one for each reference position")
+
+    if args.weights is not None and len(args.weights) != len(args.refpos):
+        parser.error("give one weight for each reference position")
+
 # Open a file handle for the Jason datafile
 f = h5py.File(args.filename, "r+")
 print('Opening dataset: ', args.filename)
 
 # Read in the spectrum
 # assuming we got the spectrum after zerofill by x2, FT, phase and baseline corrections
-dsetre = f['JasonDocument/DataPoints/0'][()]
+dsetre = f['JasonDocument/DataPoints/0'].astype(args.dtype)[()]
 npts = len(dsetre)
-wholefid = ifft(np.flipud(fftshift(dsetre, 0)), npts)
+# The spectrum is real, so the first half of the inverse transform of the
+# flipped spectrum is the first half of the rfft of the spectrum itself,
+# once it has been rotated by half its length plus one point
+wholefid = rfft(np.roll(dsetre, npts//2 + 1), npts, norm='forward', workers=args.fft_workers)
 wholefid = wholefid[:npts//2]
 
 # Zero SPECTRA
 print('Dataset size: ', npts)
 SPECTRA = np.zeros(npts)
 
-# Create the time shifted FID for the reference peak
+# Spectral parameters
 sw = f['JasonDocument/SpecInfo'].attrs['SW'][0]
 at = npts / sw
 sfrq = f['JasonDocument/SpecInfo'].attrs['SpectrometerFrequencies'][0]
@@ -104,35 +151,64 @@ sref = f['JasonDocument/SpecInfo'].attrs['SpectrumRef'][0]
 x_offset = sref / sfrq
 sp = x_offset - sw / 2.0
 
-RDcentre = args.refpos
-widthP = args.width / sfrq
-speclim = np.array((RDcentre - 0.5* widthP, RDcentre + 0.5* widthP))
+# Every combination of the given settings is a candidate, a single
+# setting being the usual case of one candidate. Each candidate uses one
+# or more of the reference regions, the row of refs giving their indices
+if args.multiref:
+    settings = np.array(list(product(args.lhz, args.ghz)))
+    columns = 'lhz, ghz'
+
+    regions = np.column_stack(np.broadcast_arrays(args.refpos, args.width))
+    refs = np.broadcast_to(np.arange(len(regions)), (len(settings), len(regions)))
+
+else:
+    settings = np.array(list(product(args.lhz, args.ghz, args.refpos, args.width)))
+    columns = 'lhz, ghz, refpos, width'
+
+    regions, refs = np.unique(settings[:, 2:], axis=0, return_inverse=True)
+    refs = refs.reshape(-1, 1)
 
-# Convert the integreation limits from ppm to number of points
-speclim = np.array(npts * (speclim - sp) / sw, dtype=int)
+lhz = settings[:, 0, None, None]
+ghz = settings[:, 1, None, None]
 
-temp = npts - np.round(npts * (RDcentre - sp) / sw)
-RDcentre = ((temp * sw) / npts) + sp
+if args.weights is None:
+    weights = np.ones(refs.shape[1])
+else:
+    weights = np.array(args.weights)
 
-if speclim[0] < 1:
-    speclim[0] = 1
+# Create the time shifted FID for the reference peak, once for each
+# distinct reference region, with all of them transformed together
+exprefspec = np.zeros((len(regions), npts), dtype=args.dtype)
+RDcentres = np.zeros(len(regions))
+speclims = np.zeros((len(regions), 2), dtype=int)
 
-if speclim[1] > npts:
-    speclim[1] = npts
+for i, (RDcentre, widthHz) in enumerate(regions):
+    widthP = widthHz / sfrq
+    speclim = np.array((RDcentre - 0.5* widthP, RDcentre + 0.5* widthP))
 
-speclim = npts - speclim
-exprefspec = dsetre.copy()
+    # Convert the integreation limits from ppm to number of points
+    speclim = np.array(npts * (speclim - sp) / sw, dtype=int)
 
-exprefspec[:speclim[1]] = 0.0
-exprefspec[speclim[0]:] = 0.0
+    temp = npts - np.round(npts * (RDcentre - sp) / sw)
+    RDcentres[i] = ((temp * sw) / npts) + sp
 
-expreffid = ifft(np.flipud(fftshift(exprefspec, 0)), npts)
-expreffid = expreffid[:npts//2]
+    if speclim[0] < 1:
+        speclim[0] = 1
 
+    if speclim[1] > npts:
+        speclim[1] = npts
 
-# Create the perfect reference peak
+    speclims[i] = npts - speclim
+    exprefspec[i, speclims[i, 1]:speclims[i, 0]] = dsetre[speclims[i, 1]:speclims[i, 0]]
 
-omega = 0.5 * sw * sfrq - (RDcentre - sp) * sfrq
+expreffid = rfft(np.roll(exprefspec, npts//2 + 1, axis=1), npts, axis=1, norm='forward', workers=args.fft_workers)
+expreffid = expreffid[:, :npts//2]
+
+
+# Create the perfect reference peaks for every candidate, as one
+# (candidates x references x time) grid
+
+omega = (0.5 * sw * sfrq - (RDcentres[refs] - sp) * sfrq)[..., None]
 
 t = np.linspace(0, 0.5*at, npts//2)
 reffid = np.exp(1j * 2.0 * np.pi * omega * t)
@@ -140,23 +216,111 @@ reffid = np.exp(1j * 2.0 * np.pi * omega * t)
 if args.sat:
         reffid = reffid + args.abundance/200.0*np.exp(1j * 2.0 * np.pi * (omega + args.jxy/2.0) * t) + args.abundance/200.0*np.exp(1j * 2.0 * np.pi * (omega - args.jxy/2.0) * t)
 
-reffid = reffid * np.exp(-t * np.pi * args.lhz - (t / args.ghz)**2)
+reffid = reffid * np.exp(-t * np.pi * lhz - (t / ghz)**2)
+reffid = reffid.astype(np.result_type(args.dtype, np.complex64))
+
+# Create the correction fids
+
+corrfid = expreffid[refs] / reffid
+corrfid = corrfid / corrfid[..., :1]
+
+if args.segmented:
+    # Correct the whole FID with each reference, then take each point of
+    # the spectrum from the correction of the closest reference
+    endfid = wholefid / corrfid
+    endfid[..., 0] = 0.5 * endfid[..., 0]
+
+    SPECTRA = np.flip(fftshift(fft(endfid, npts, axis=-1, workers=args.fft_workers), axes=-1), axis=-1)
+
+    centres = 0.5 * speclims[refs[0]].sum(axis=1)
+    segment = np.abs(np.arange(npts)[:, None] - centres).argmin(axis=1)
+    SPECTRA = np.take_along_axis(SPECTRA, segment[None, None, :], axis=1)[:, 0]
+
+else:
+    # Weighted combination of the corrections of all the references
+    corrfid = np.tensordot(corrfid, (weights / weights.sum()).astype(args.dtype), axes=(1, 0))
+
+    endfid = wholefid / corrfid
+    endfid[:, 0] = 0.5 * endfid[:, 0]
+
+    SPECTRA = np.flip(fftshift(fft(endfid, npts, axis=1, workers=args.fft_workers), axes=1), axis=1)
+
+
+if len(settings) > 1 or args.multiref:
+    # Record the settings of the sweep and the references used in the document
+
+    if 'JasonDocument/ReferenceDeconvolution' in f:
+        del f['JasonDocument/ReferenceDeconvolution']
+
+    sweep = f.create_group('JasonDocument/ReferenceDeconvolution')
+    sweep.create_dataset('Settings', data=settings)
+    sweep.attrs['Columns'] = columns
+
+    if args.multiref:
+        sweep.create_dataset('References', data=regions)
+        sweep.create_dataset('Weights', data=weights)
+
+if len(settings) == 1:
+    # Write out the changes to the original file
+
+    del f['/JasonDocument/DataPoints/0']
+    del f['/JasonDocument/DataPoints/1']
+    f.create_dataset('/JasonDocument/DataPoints/0', data=SPECTRA[0].real)
+    f.create_dataset('/JasonDocument/DataPoints/1', data=SPECTRA[0].imag)
+    print('Dataset changed')
+
+elif args.output == 'stack':
+    # Replace the spectrum with the stack of candidate spectra
+
+    # F1 is the candidate axis, one unit per candidate, centred so that it
+    # reads n at the first row down to 1 at the last
+    ncand = len(settings)
+    info = f['JasonDocument/SpecInfo'].attrs
+
+    length = f['JasonDocument'].attrs['Length']
+    f['JasonDocument'].attrs['Length'] = np.array((npts, ncand), dtype=length.dtype)
+    info['SW'] = np.array((info['SW'][0], ncand), dtype=info['SW'].dtype)
+    info['SpectrometerFrequencies'] = np.array((sfrq, 1.0), dtype=info['SpectrometerFrequencies'].dtype)
+    info['SpectrumRef'] = np.array((sref, 0.5 * ncand), dtype=info['SpectrumRef'].dtype)
+
+    del f['/JasonDocument/DataPoints/0']
+    del f['/JasonDocument/DataPoints/1']
+    f.create_dataset('/JasonDocument/DataPoints/0', data=SPECTRA.real)
+    f.create_dataset('/JasonDocument/DataPoints/1', data=SPECTRA.imag)
+    print('Dataset changed to ', len(settings), ' candidate spectra')
+
+else:
+    # Score each candidate by the full width at half height of each of its
+    # reference peaks, interpolated between the points either side
+
+    linewidth = np.zeros(refs.shape)
+
+    for (i, j), r in np.ndenumerate(refs):
+        spec = SPECTRA[i, speclims[r, 1]:speclims[r, 0]].real
+        peak = spec.argmax()
+        half = 0.5 * spec[peak]
+        below = np.flatnonzero(spec < half)
+
+        left = below[below < peak].max(initial=-1)
+        right = below[below > peak].min(initial=len(spec))
+
+        left_edge = left + (half - spec[left]) / (spec[left + 1] - spec[left]) if left >= 0 else 0.0
+        right_edge = right - (half - spec[right]) / (spec[right - 1] - spec[right]) if right < len(spec) else len(spec) - 1.0
 
-# Create the correction fid
+        linewidth[i, j] = (right_edge - left_edge) * sw * sfrq / npts
 
-corrfid = expreffid / reffid
-corrfid = corrfid / corrfid[0]
-endfid = wholefid / corrfid
-endfid[0] = 0.5 * endfid[0]
+    if args.multiref:
+        sweep.create_dataset('Linewidth', data=linewidth)
 
-SPECTRA = np.flipud(fftshift(fft(endfid, npts), 0))
+        print('   lhz      ghz   linewidth of each reference (Hz)')
+        for setting, lw in zip(settings, linewidth):
+            print('{0:6.2f} {1:8.2f}'.format(*setting), ' '.join('{0:8.3f}'.format(x) for x in lw))
 
+    else:
+        sweep.create_dataset('Linewidth', data=linewidth[:, 0])
 
-# Write out the changes to the original file
+        print('   lhz      ghz   refpos    width   linewidth (Hz)')
+        for setting, lw in zip(settings, linewidth[:, 0]):
+            print('{0:6.2f} {1:8.2f} {2:8.3f} {3:8.1f} {4:11.3f}'.format(*setting, lw))
 
-del f['/JasonDocument/DataPoints/0']
-del f['/JasonDocument/DataPoints/1']
-f.create_dataset('/JasonDocument/DataPoints/0', data=SPECTRA.real)
-f.create_dataset('/JasonDocument/DataPoints/1', data=SPECTRA.imag)
-print('Dataset changed')
 f.close()
@@ -40,6 +40,10 @@
 #     use the -s flag to take into account satellites with the following two properties (default is false, no value given just use as -s)
 #     use the -j flag to set the value of the heteronuclear J coupling for satellite of reference signal (default 6.6 Hz TMS)
 #     use the -a flag to set the abundance of the heteronucleus for satellite of reference signal (default 4.67 Hz for 29Si)
+#     use the -b flag to set the number of rows processed together (default 64), which limits the memory used
+#     use the --fft-workers flag to set the number of threads used for the Fourier transforms (default -1, all)
+#     use the --dtype flag to set the precision the spectrum is processed and stored in, float64 (default) or float32
+#       (complex64 for the FIDs)
 #
 #  Set "Data file" to "Spectrum as JJH5"
 #
@@ -57,7 +61,7 @@
 import h5py
 from argparse import ArgumentParser
 import numpy as np
-from scipy.fft import fft, ifft, fftshift
+from scipy.fft import fft, rfft, fftshift
 
 # Process commandline options
 parser = ArgumentParser()
@@ -77,6 +81,12 @@ parser.add_argument("-s", "--sat", action="store_true")
 parser.add_argument("-j", "--jxy", action="store", type=float, default=6.6)
 # abundance of reference satellite in % 
 parser.add_argument("-a", "--abundance", action="store", type=float, default=4.67)
+# number of rows processed together
+parser.add_argument("-b", "--block-rows", action="store", type=int, default=64)
+# number of threads used for the Fourier transforms
+parser.add_argument("--fft-workers", action="store", type=int, default=-1)
+# precision of the processing and of the result
+parser.add_argument("--dtype", action="store", default="float64", choices=["float64", "float32"])
 
 args = parser.parse_args()
 
@@ -88,86 +98,93 @@ nptsF2 = f['JasonDocument'].attrs['Length'][0]
 nptsF1 = f['JasonDocument'].attrs['Length'][1]
 
 # Read in the spectrum
-dsetreAll = f['JasonDocument/DataPoints/0'][()]
+dsetreAll = f['JasonDocument/DataPoints/0'].astype(args.dtype)[()]
 
 print('Dataset size: ', nptsF2, ' * ', nptsF1)
-# Zero final output spectra
-SPECTRA_ALL = np.array([], dtype=np.complex_)
 
-for i in range(nptsF1):
-    npts = nptsF2
-#    print('i: ', i)
-    dsetre = dsetreAll[i,:].copy()
-    
-    wholefid = ifft(np.flipud(fftshift(dsetre, 0)), npts)
-    wholefid = wholefid[:npts//2]
-
-# Zero SPECTRA
-    SPECTRA = np.zeros(npts)
+# Every row shares the same spectral parameters, so the reference region and
+# the perfect reference peak are set up once
+npts = nptsF2
+dsetreAll = dsetreAll.reshape(nptsF1, nptsF2)
 
 # Create the time shifted FID for the reference peak
-    sw = f['JasonDocument/SpecInfo'].attrs['SW'][0]
-    at = npts / sw
-    sfrq = f['JasonDocument/SpecInfo'].attrs['SpectrometerFrequencies'][0]
-    sw = sw / sfrq
-    sref = f['JasonDocument/SpecInfo'].attrs['SpectrumRef'][0]
-    x_offset = sref / sfrq
-    sp = x_offset - sw / 2.0
-
-    RDcentre = args.refpos
-    widthP = args.width / sfrq
-    speclim = np.array((RDcentre - 0.5* widthP, RDcentre + 0.5* widthP))
+sw = f['JasonDocument/SpecInfo'].attrs['SW'][0]
+at = npts / sw
+sfrq = f['JasonDocument/SpecInfo'].attrs['SpectrometerFrequencies'][0]
+sw = sw / sfrq
+sref = f['JasonDocument/SpecInfo'].attrs['SpectrumRef'][0]
+x_offset = sref / sfrq
+sp = x_offset - sw / 2.0
+
+RDcentre = args.refpos
+widthP = args.width / sfrq
+speclim = np.array((RDcentre - 0.5* widthP, RDcentre + 0.5* widthP))
 
 # Convert the integreation limits from ppm to number of points
-    speclim = np.array(npts * (speclim - sp) / sw, dtype=int)
+speclim = np.array(npts * (speclim - sp) / sw, dtype=int)
 
-    temp = npts - np.round(npts * (RDcentre - sp) / sw)
-    RDcentre = ((temp * sw) / npts) + sp
+temp = npts - np.round(npts * (RDcentre - sp) / sw)
+RDcentre = ((temp * sw) / npts) + sp
 
-    if speclim[0] < 1:
-        speclim[0] = 1
+if speclim[0] < 1:
+    speclim[0] = 1
 
-    if speclim[1] > npts:
-        speclim[1] = npts
+if speclim[1] > npts:
+    speclim[1] = npts
 
-    speclim = npts - speclim
-    exprefspec = dsetre.copy()
+speclim = npts - speclim
 
-    exprefspec[:speclim[1]] = 0.0
-    exprefspec[speclim[0]:] = 0.0
+# Create the perfect reference peak
+omega = 0.5 * sw * sfrq - (RDcentre - sp) * sfrq
 
-    expreffid = ifft(np.flipud(fftshift(exprefspec, 0)), npts)
-    expreffid = expreffid[:npts//2]
+t = np.linspace(0, 0.5*at, npts//2)
+reffid = np.exp(1j * 2.0 * np.pi * omega * t)
 
-# Create the perfect reference peak
-    omega = 0.5 * sw * sfrq - (RDcentre - sp) * sfrq
+if args.sat:
+    reffid = reffid + args.abundance/200.0*np.exp(1j * 2.0 * np.pi * (omega + args.jxy/2.0) * t) + args.abundance/200.0*np.exp(1j * 2.0 * np.pi * (omega - args.jxy/2.0) * t)
 
-    t = np.linspace(0, 0.5*at, npts//2)
-    reffid = np.exp(1j * 2.0 * np.pi * omega * t)
+reffid = reffid * np.exp(-t * np.pi * args.lhz - (t / args.ghz)**2)
+reffid = reffid.astype(np.result_type(args.dtype, np.complex64))
 
-    if args.sat:
-        reffid = reffid + args.abundance/200.0*np.exp(1j * 2.0 * np.pi * (omega + args.jxy/2.0) * t) + args.abundance/200.0*np.exp(1j * 2.0 * np.pi * (omega - args.jxy/2.0) * t)
+# Preallocate the (nF1 x nF2) outputs under temporary names, keeping the 2D
+# layout, so the data is only replaced once every row has been processed
+SPECTRA_RE = f.create_dataset('/JasonDocument/DataPoints/0_refdec', shape=(nptsF1, nptsF2), dtype=args.dtype)
+SPECTRA_IM = f.create_dataset('/JasonDocument/DataPoints/1_refdec', shape=(nptsF1, nptsF2), dtype=args.dtype)
 
-    reffid = reffid * np.exp(-t * np.pi * args.lhz - (t / args.ghz)**2)
+# Process blocks of rows together, transforming along the F2 axis, and write
+# each block straight into its rows of the output
+for i in range(0, nptsF1, args.block_rows):
+    dsetre = dsetreAll[i:i + args.block_rows]
 
-    
+    # The spectra are real, so the first half of the inverse transform of the
+    # flipped spectra is the first half of the rfft of the spectra themselves,
+    # once they have been rotated by half their length plus one point
+    wholefid = rfft(np.roll(dsetre, npts//2 + 1, axis=1), npts, axis=1, norm='forward', workers=args.fft_workers)
+    wholefid = wholefid[:, :npts//2]
 
-# Create the correction fid
+    exprefspec = np.zeros_like(dsetre)
+    exprefspec[:, speclim[1]:speclim[0]] = dsetre[:, speclim[1]:speclim[0]]
+
+    expreffid = rfft(np.roll(exprefspec, npts//2 + 1, axis=1), npts, axis=1, norm='forward', workers=args.fft_workers)
+    expreffid = expreffid[:, :npts//2]
+
+# Create the correction fid for every row
     corrfid = expreffid / reffid
-    corrfid = corrfid / corrfid[0]
+    corrfid = corrfid / corrfid[:, :1]
     endfid = wholefid / corrfid
-    endfid[0] = 0.5 * endfid[0]
+    endfid[:, 0] = 0.5 * endfid[:, 0]
 
-    SPECTRA = np.flipud(fftshift(fft(endfid, npts), 0))
-        
-# Store results per traces
-    SPECTRA_ALL = np.append(SPECTRA_ALL, SPECTRA)
+    SPECTRA = np.flip(fftshift(fft(endfid, npts, axis=1, workers=args.fft_workers), axes=1), axis=1)
 
-# Write out the changes to the original file
+# Store results per block of traces
+    SPECTRA_RE[i:i + SPECTRA.shape[0]] = SPECTRA.real
+    SPECTRA_IM[i:i + SPECTRA.shape[0]] = SPECTRA.imag
 
+# Replace the data with the results
 del f['/JasonDocument/DataPoints/0']
 del f['/JasonDocument/DataPoints/1']
-f.create_dataset('/JasonDocument/DataPoints/0', data=SPECTRA_ALL.real)
-f.create_dataset('/JasonDocument/DataPoints/1', data=SPECTRA_ALL.imag)
+f.move('/JasonDocument/DataPoints/0_refdec', '/JasonDocument/DataPoints/0')
+f.move('/JasonDocument/DataPoints/1_refdec', '/JasonDocument/DataPoints/1')
+
 print('Dataset changed')
 f.close()
@@ -0,0 +1,276 @@
+#!python3
+
+# -------------------------------------------------------------------------------
+# --
+# -- JEOL Ltd.
+# -- 1-2 Musashino 3-Chome
+# -- Akishima Tokyo 196-8558 Japan
+# --
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# --++---------------------------------------------------------------------------
+# --
+# -- ModuleName : relaxation.py
+# -- ModuleType : Support module for the example external command scripts for JASON
+# -- Purpose : Relaxation decay models and batched fitting
+# -- Language : Python
+# --
+# --##---------------------------------------------------------------------------
+#
+# Decay models for relaxation (T1/T2) and diffusion analysis, for use by the
+# scripts in this folder (e.g. "from relaxation import monoexp, fit_monoexp")
+#
+# Every model takes a parameter array p of shape (..., nparams) and a time
+# axis t of shape (npts,), and returns an array of shape (..., npts), so a
+# single parameter vector gives a single curve (as expected by leastsq) and
+# a (ncurves x nparams) array gives a batch of curves. The matching Jacobian
+# functions return the derivatives with respect to each parameter, with
+# shape (..., npts, nparams).
+#
+# Models:
+#   monoexp     A.exp(-t/T),                        p = [A, T]
+#   biexp       A1.exp(-t/T1) + A2.exp(-t/T2),      p = [A1, T1, A2, T2]
+#   stretched   A.exp(-(t/T)^beta),                 p = [A, T, beta]
+
+import numpy as np
+
+
+def monoexp(p, t):
+    """Mono-exponential decay A.exp(-t/T)"""
+
+    p = np.asarray(p)
+
+    return p[..., 0:1] * np.exp(-t / p[..., 1:2])
+
+
+def monoexp_jacobian(p, t):
+    """Derivatives of monoexp with respect to [A, T]"""
+
+    p = np.asarray(p)
+    decay = np.exp(-t / p[..., 1:2])
+
+    return np.stack((decay, p[..., 0:1] * t / p[..., 1:2]**2 * decay), axis=-1)
+
+
+def biexp(p, t):
+    """Bi-exponential decay A1.exp(-t/T1) + A2.exp(-t/T2)"""
+
+    p = np.asarray(p)
+
+    return monoexp(p[..., 0:2], t) + monoexp(p[..., 2:4], t)
+
+
+def biexp_jacobian(p, t):
+    """Derivatives of biexp with respect to [A1, T1, A2, T2]"""
+
+    p = np.asarray(p)
+
+    return np.concatenate((monoexp_jacobian(p[..., 0:2], t), monoexp_jacobian(p[..., 2:4], t)), axis=-1)
+
+
+def stretched(p, t):
+    """Stretched exponential decay A.exp(-(t/T)^beta)"""
+
+    p = np.asarray(p)
+
+    return p[..., 0:1] * np.exp(-(t / p[..., 1:2])**p[..., 2:3])
+
+
+def stretched_jacobian(p, t):
+    """Derivatives of stretched with respect to [A, T, beta]"""
+
+    p = np.asarray(p)
+    A, T, beta = p[..., 0:1], p[..., 1:2], p[..., 2:3]
+
+    x = t / T
+    xb = x**beta
+    decay = np.exp(-xb)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_x = np.where(x > 0.0, np.log(x), 0.0)
+
+    return np.stack((decay, A * decay * beta * xb / T, -A * decay * xb * log_x), axis=-1)
+
+
+def residuals(p, model, t, y):
+    """Residuals in the form expected by scipy.optimize.leastsq"""
+
+    return y - model(p, t)
+
+
+def loglinear_estimate(t, y):
+    """Initial [A, T] of a mono-exponential decay from a straight line fit to log(y).
+
+    Works along the last axis of y, so a batch of curves gives an array of
+    estimates with shape (..., 2). Each point is weighted by y^2 to allow for
+    the log transform amplifying the noise on small values, and points with
+    y <= 0 are ignored.
+    """
+
+    y = np.asarray(y, dtype=float)
+
+    w = np.where(y > 0.0, y**2, 0.0)
+    log_y = np.log(np.where(y > 0.0, y, 1.0))
+
+    S = w.sum(axis=-1)
+    St = (w * t).sum(axis=-1)
+    Stt = (w * t**2).sum(axis=-1)
+    Sy = (w * log_y).sum(axis=-1)
+    Sty = (w * t * log_y).sum(axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (S * Sty - St * Sy) / (S * Stt - St**2)
+        intercept = (Sy - slope * St) / S
+
+        # Fall back to the length of the time axis for curves that do not decay
+
+        T = np.where(slope < 0.0, -1.0 / slope, t[-1])
+
+    A = np.where(np.isfinite(intercept), np.exp(intercept), y.max(axis=-1))
+
+    return np.stack((A, np.where(np.isfinite(T), T, t[-1])), axis=-1)
+
+
+def fit(model, jacobian, t, data, p0, max_itr=100, ftol=1.49012e-8):
+    """Levenberg-Marquardt fit of model to every row of data at once.
+
+    The damped normal equations of all the curves that have not yet
+    converged are built from the analytic Jacobian and solved together, and
+    each curve keeps its own damping factor. Returns the (ncurves x nparams)
+    array of fitted parameters.
+    """
+
+    data = np.atleast_2d(data)
+    ncurves = data.shape[0]
+
+    p = np.array(np.broadcast_to(p0, (ncurves, np.shape(p0)[-1])), dtype=float)
+    lam = np.full(ncurves, 1.0e-3)
+
+    resid = data - model(p, t)
+    cost = (resid**2).sum(axis=1)
+
+    active = np.arange(ncurves)
+
+    for _ in range(max_itr):
+        # Damped normal equations for each active curve
+
+        J = jacobian(p[active], t)
+        JTJ = np.einsum('bij,bik->bjk', J, J)
+        g = np.einsum('bij,bi->bj', J, resid[active])
+
+        la = lam[active]
+        diag = np.einsum('bjj->bj', JTJ)
+        A = JTJ + (la[:, None] * diag)[:, :, None] * np.eye(p.shape[1])
+
+
+        # Accept the steps that reduce the residual, adjusting the damping of each curve
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            try:
+                step = np.linalg.solve(A, g[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                step = np.array([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(A, g)])
+
+            p_new = p[active] + step
+            resid_new = data[active] - model(p_new, t)
+            cost_new = (resid_new**2).sum(axis=1)
+
+        accept = np.isfinite(cost_new) & (cost_new < cost[active])
+        converged = accept & (cost[active] - cost_new <= ftol * cost[active])
+
+        idx = active[accept]
+        p[idx] = p_new[accept]
+        resid[idx] = resid_new[accept]
+        cost[idx] = cost_new[accept]
+
+        lam[active] = np.where(accept, la / 10.0, la * 10.0)
+
+        active = active[~converged & (lam[active] < 1.0e10)]
+
+        if active.size == 0:
+            break
+
+    return p
+
+
+def fit_monoexp(t, data, p0, max_itr=100, ftol=1.49012e-8):
+    """Levenberg-Marquardt fit of A.exp(-t/T) to every row of data at once.
+
+    A faster special case of fit(). With e = exp(-t/T), the cost, gradient
+    and (analytic) Gauss-Newton matrix of every curve only need the sums of
+    e.e, t.e.e, t^2.e.e, e.y and t.e.y, so each trial step costs one exp and
+    two matrix products over the curves that have not yet converged. The
+    2x2 damped normal equations are then solved in closed form for all
+    curves together. Returns the (ncurves x 2) array of [A, T] parameters.
+    """
+
+    data = np.atleast_2d(data)
+    ncurves = data.shape[0]
+    tpow = np.stack((np.ones_like(t), t, t**2), axis=1)
+
+    def moments(T, y):
+        e = np.exp(-t / T[:, None])
+        return np.dot(e * e, tpow), np.dot(e * y, tpow[:, :2])
+
+    def sum_sq(A, ee, ey, yy):
+        return yy - 2.0 * A * ey[:, 0] + A**2 * ee[:, 0]
+
+    p = np.array(np.broadcast_to(p0, (ncurves, 2)), dtype=float)
+    lam = np.full(ncurves, 1.0e-3)
+
+    yy = (data**2).sum(axis=1)
+    ee, ey = moments(p[:, 1], data)
+    cost = sum_sq(p[:, 0], ee, ey, yy)
+
+    active = np.arange(ncurves)
+
+    for _ in range(max_itr):
+        # Jacobian with respect to A and T gives the damped normal equations
+
+        A, T, la = p[active, 0], p[active, 1], lam[active]
+        eea, eya = ee[active], ey[active]
+        scale = A / T**2
+
+        a = eea[:, 0] * (1.0 + la)
+        b = scale * eea[:, 1]
+        c = scale**2 * eea[:, 2] * (1.0 + la)
+        g_A = eya[:, 0] - A * eea[:, 0]
+        g_T = scale * (eya[:, 1] - A * eea[:, 1])
+
+        det = a * c - b**2
+
+
+        # Accept the steps that reduce the residual, adjusting the damping of each curve
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            p_new = np.column_stack((A + (c * g_A - b * g_T) / det, T + (a * g_T - b * g_A) / det))
+            ee_new, ey_new = moments(p_new[:, 1], data[active])
+            cost_new = sum_sq(p_new[:, 0], ee_new, ey_new, yy[active])
+
+        accept = (p_new[:, 1] > 0.0) & (cost_new < cost[active])
+        converged = accept & (cost[active] - cost_new <= ftol * cost[active])
+
+        idx = active[accept]
+        p[idx] = p_new[accept]
+        ee[idx] = ee_new[accept]
+        ey[idx] = ey_new[accept]
+        cost[idx] = cost_new[accept]
+
+        lam[active] = np.where(accept, la / 10.0, la * 10.0)
+
+        active = active[~converged & (lam[active] < 1.0e10)]
+
+        if active.size == 0:
+            break
+
+    return p
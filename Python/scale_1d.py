@@ -42,7 +42,8 @@
 #
 #   Set "arguments" to the path of the script, specifying the use of a temporary 
 #   file
-#     (e.g. "C:\Users\<username>\.jason\externalNMRProcessing\python\scale_1d.py -f $TMPFILE -m <MODE> [--scale <VALUE>])
+#     (e.g. "C:\Users\<username>\.jason\externalNMRProcessing\python\scale_1d.py -f $TMPFILE -m <MODE> [--scale <VALUE>] [--dtype float32])
+#     use the --dtype flag to set the precision the spectrum is scaled and stored in, float64 (default) or float32
 #
 # Press "Apply"
 
@@ -58,6 +59,7 @@ parser = ArgumentParser()
 parser.add_argument("-f", "--filename", action="store")
 parser.add_argument("-m", "--mode", action="store")
 parser.add_argument("--value", action="store", default=1.0, type=float)
+parser.add_argument("--dtype", action="store", default="float64", choices=["float64", "float32"])
 args = parser.parse_args()
 
 
@@ -69,8 +71,8 @@ print('Opening dataset: ', args.filename)
 
 # Read the spectrum
 
-dataset_real = f['JasonDocument/DataPoints/0'][()]
-dataset_imag = f['JasonDocument/DataPoints/1'][()]
+dataset_real = f['JasonDocument/DataPoints/0'].astype(args.dtype)[()]
+dataset_imag = f['JasonDocument/DataPoints/1'].astype(args.dtype)[()]
 
 
 # Scale the spectrum